@@ -0,0 +1,20 @@
+import argparse
+
+from bench import imports, phash, readers, sparse_phash, startup, suite
+
+BENCHMARKS = {
+    "suite": suite,
+    "readers": readers,
+    "phash": phash,
+    "sparse_phash": sparse_phash,
+    "imports": imports,
+    "startup": startup,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the WBCH-Organizer")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    for name, module in BENCHMARKS.items():
+        module.add_arguments(subparsers.add_parser(name, help=module.DESCRIPTION))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark].run(args)
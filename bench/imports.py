@@ -0,0 +1,64 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+DESCRIPTION = "Audit the import time of main.py with -X importtime and compare it with a baseline"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--module", type=str, default="main", help="Module to import")
+    parser.add_argument("--top", type=int, default=15, help="Slowest top level imports to list")
+    parser.add_argument("--repeat", type=int, default=5, help="Imports to take the fastest of")
+    parser.add_argument("--baseline", type=str, help="Baseline json to compare with")
+    parser.add_argument("--save_baseline", type=str, help="Write the measured times to this baseline json")
+
+
+def measure_import_times(module: str) -> Dict[str, int]:
+    # Cumulative microseconds per module, as reported by -X importtime on stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=Path(__file__).resolve().parent.parent, capture_output=True, text=True, check=True)
+    # Imports are listed after the imports they made, nesting is shown by two spaces per level
+    children: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name[1:]
+        if not name.startswith(" "):
+            if name == module:
+                return {module: int(cumulative), **children}
+            children = {}
+        elif not name.startswith("   "):
+            children[name.strip()] = int(cumulative)
+    raise ValueError(f"{module} not found in the -X importtime output")
+
+
+def fastest_times(module: str, repeat: int) -> Dict[str, int]:
+    runs = [measure_import_times(module) for _ in range(repeat)]
+    return {name: min(run.get(name, times) for run in runs) for name, times in runs[0].items()}
+
+
+def run(args: argparse.Namespace):
+    times = fastest_times(args.module, args.repeat)
+    total = times.pop(args.module, sum(times.values()))
+    baseline: Dict[str, int] = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    print(f"import {args.module}: {total / 1000:.1f} ms, fastest of {args.repeat}")
+    slowest: List[Tuple[str, int]] = sorted(times.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    print(f"{'module':<30}{'ms':>10}{'baseline ms':>14}")
+    for name, microseconds in slowest:
+        baseline_time = f"{baseline[name] / 1000:.1f}" if name in baseline else "-"
+        print(f"{name:<30}{microseconds / 1000:>10.1f}{baseline_time:>14}")
+    if args.module in baseline:
+        print(f"{'total':<30}{total / 1000:>10.1f}{baseline[args.module] / 1000:>14.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({args.module: total, **times}, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
@@ -0,0 +1,51 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from epdb import load_db
+from file_management import walk_files
+from hasher import phash_file, phash_file_videohash2, hash_file
+
+DESCRIPTION = "Compare the in memory phash with videohash2 and the phash values in the epdb"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-p", "--base_path", type=str, required=True, help="Directory with videos to hash")
+    parser.add_argument("--epdb", type=str, default="epdb.json", help="epdb to compare known files against")
+    parser.add_argument("--limit", type=int, default=0, help="Only hash the first n files")
+
+
+def run(args: argparse.Namespace):
+    db = load_db(args.epdb)
+    files = sorted(Path(entry.path) for entry in walk_files(args.base_path))
+    if args.limit:
+        files = files[:args.limit]
+
+    same_count = 0
+    db_checked = 0
+    db_same = 0
+    time_in_memory = 0.0
+    time_videohash2 = 0.0
+    for file_path in files:
+        start = time.perf_counter()
+        phash = phash_file(file_path)[1].get("phash")
+        time_in_memory += time.perf_counter() - start
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as work_dir:
+            reference_phash = phash_file_videohash2(file_path, work_dir=Path(work_dir))[1].get("phash")
+        time_videohash2 += time.perf_counter() - start
+
+        same_count += phash == reference_phash
+        line = f"{'✅' if phash == reference_phash else '❌'} {file_path.name}: {phash} videohash2: {reference_phash}"
+        version_tuple = db.get_version_by_hash("hash", hash_file(file_path)[1].get("hash")) if db else None
+        if version_tuple:
+            db_phash = version_tuple[2].hashes.get("phash")
+            db_checked += 1
+            db_same += phash == db_phash
+            line += f" epdb: {db_phash}"
+        print(line)
+
+    print(f"\nSame as videohash2: {same_count}/{len(files)}")
+    print(f"Same as epdb: {db_same}/{db_checked} files known to the epdb")
+    print(f"In memory: {time_in_memory:.1f}s, videohash2: {time_videohash2:.1f}s")
@@ -0,0 +1,58 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from hasher import READERS, hash_file
+
+DESCRIPTION = "Compare the reader modes and block sizes of hash_file"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--file", type=str, help="File to hash, a random file is generated if omitted")
+    parser.add_argument("--size", type=int, default=512, help="Size of the generated file in MiB")
+    parser.add_argument("--block_sizes", type=int, nargs="+", default=[64, 1024, 8192],
+                        help="Block sizes in KiB to compare")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per reader and block size")
+    parser.add_argument("--cold", action="store_true",
+                        help="Evict the file from the page cache before every run (posix only)")
+
+
+def create_random_file(file_path: Path, size_mib: int):
+    with open(file_path, "wb") as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1024 * 1024))
+
+
+def evict_from_page_cache(file_path: Path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with open(file_path, "rb") as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.file:
+            file_path = Path(args.file)
+        else:
+            file_path = Path(tmp_dir) / "random.bin"
+            create_random_file(file_path, args.size)
+        file_size = file_path.stat().st_size
+
+        print(f"Hashing {file_path} ({file_size / 2 ** 20:.0f} MiB), best of {args.repeat} runs")
+        print(f"{'reader':<10}{'block':>10}{'best MiB/s':>14}{'median MiB/s':>14}")
+        for reader in READERS:
+            for block_size in args.block_sizes:
+                timings = []
+                for _ in range(args.repeat):
+                    if args.cold:
+                        evict_from_page_cache(file_path)
+                    start = time.perf_counter()
+                    hash_file(file_path, block_size=block_size * 1024, reader=reader)
+                    timings.append(time.perf_counter() - start)
+                best = file_size / min(timings) / 2 ** 20
+                median = file_size / statistics.median(timings) / 2 ** 20
+                print(f"{reader:<10}{block_size:>6} KiB{best:>14.1f}{median:>14.1f}")
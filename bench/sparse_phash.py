@@ -0,0 +1,85 @@
+import argparse
+import itertools
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from file_management import walk_files, calculate_phash_distance
+from hasher import phash_file, sparse_phash_file
+from video_phash import get_ffmpeg_path
+
+DESCRIPTION = "Compare the keyframe sparse phash with the full phash in speed and match rate"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-p", "--base_path", type=str, required=True, help="Directory with videos to hash")
+    parser.add_argument("--distance", type=int, default=8, help="Maximum distance for two videos to match")
+    parser.add_argument("--limit", type=int, default=0, help="Only hash the first n files")
+    parser.add_argument("--reencode", action="store_true",
+                        help="Also hash a smaller re-encoded copy of every file to check the hashes are stable")
+
+
+def reencode(file_path: Path, work_dir: Path) -> Optional[Path]:
+    # Broken files that ffmpeg can't decode are left out of the stability check
+    copy_path = work_dir / f"{file_path.stem}.mp4"
+    result = subprocess.run([get_ffmpeg_path(), "-y", "-i", str(file_path), "-vf", "scale=-2:360", "-c:v", "libx264",
+                    "-crf", "30", "-preset", "veryfast", "-an", str(copy_path)],
+                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return copy_path if result.returncode == 0 else None
+
+
+def run(args: argparse.Namespace):
+    files = sorted(Path(entry.path) for entry in walk_files(args.base_path))
+    if args.limit:
+        files = files[:args.limit]
+
+    timings = {"phash": 0.0, "sphash": 0.0}
+    hashes: Dict[str, Dict[Path, str]] = {"phash": {}, "sphash": {}}
+    copy_distances: Dict[str, Dict[Path, float]] = {"phash": {}, "sphash": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for file_path in files:
+            line = f"{file_path.name}:"
+            copy_path = reencode(file_path, Path(work_dir)) if args.reencode else None
+            for hash_name, hash_func in (("phash", phash_file), ("sphash", sparse_phash_file)):
+                start = time.perf_counter()
+                value = hash_func(file_path)[1].get(hash_name)
+                timings[hash_name] += time.perf_counter() - start
+                if value is None:
+                    continue
+                hashes[hash_name][file_path] = value
+                line += f" {hash_name} {value}"
+                if copy_path:
+                    copy_value = hash_func(copy_path)[1].get(hash_name)
+                    if copy_value is not None:
+                        copy_distances[hash_name][file_path] = calculate_phash_distance(value, copy_value)
+                        line += f" (re-encoded distance {copy_distances[hash_name][file_path]})"
+            print(line)
+
+    print(f"\nphash: {timings['phash']:.1f}s, sphash: {timings['sphash']:.1f}s "
+          f"({timings['phash'] / max(timings['sphash'], 1e-9):.1f}x)")
+
+    # Pairs of library files the full phash considers the same video are the reference for the sparse one
+    both = [file_path for file_path in files if file_path in hashes["phash"] and file_path in hashes["sphash"]]
+    agree = 0
+    phash_pairs = 0
+    sphash_pairs = 0
+    shared_pairs = 0
+    pair_count = 0
+    for first, second in itertools.combinations(both, 2):
+        pair_count += 1
+        phash_match = calculate_phash_distance(hashes["phash"][first], hashes["phash"][second]) <= args.distance
+        sphash_match = calculate_phash_distance(hashes["sphash"][first], hashes["sphash"][second]) <= args.distance
+        agree += phash_match == sphash_match
+        phash_pairs += phash_match
+        sphash_pairs += sphash_match
+        shared_pairs += phash_match and sphash_match
+    print(f"Pairs judged the same: {agree}/{pair_count}, matches phash: {phash_pairs}, sphash: {sphash_pairs}, "
+          f"both: {shared_pairs}")
+
+    for hash_name, distances in copy_distances.items():
+        if distances:
+            stable = sum(distance <= args.distance for distance in distances.values())
+            print(f"{hash_name} re-encoded copies matched: {stable}/{len(distances)}, "
+                  f"max distance {max(distances.values())}")
@@ -0,0 +1,87 @@
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+from hasher import quick_hash_file
+from worker_pool import WorkerPool, hash_batch
+
+DESCRIPTION = "Compare a new process pool per hashing phase with the shared worker pool, and time program startup"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--phases", type=int, default=3, help="Hashing phases, like quick hash, full hash and watch")
+    parser.add_argument("--files", type=int, default=256, help="Small files hashed per phase")
+    parser.add_argument("--workers", type=int, default=4, help="Pool workers")
+    parser.add_argument("--batch_size", type=int, default=16, help="Files per task of the shared pool")
+    parser.add_argument("--frozen", type=str,
+                        help="PyInstaller build to time next to the unfrozen main.py, started with --help")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per startup measurement")
+
+
+def create_files(directory: Path, count: int) -> List[Path]:
+    file_paths = []
+    for i in range(count):
+        file_path = directory / f"{i}.mp4"
+        file_path.write_bytes(os.urandom(64 * 1024))
+        file_paths.append(file_path)
+    return file_paths
+
+
+def run_pool_per_phase(file_paths: List[Path], phases: int, workers: int) -> float:
+    # The behavior before the shared pool, every phase spawns and imports its own workers
+    start = time.perf_counter()
+    for _ in range(phases):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(quick_hash_file, file_path) for file_path in file_paths]:
+                future.result()
+    return time.perf_counter() - start
+
+
+def run_shared_pool(file_paths: List[Path], phases: int, workers: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    with WorkerPool(workers, workers) as worker_pool:
+        for _ in range(phases):
+            jobs = [(file_path, {"qhash"}) for file_path in file_paths]
+            batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+            for future in [worker_pool.io_executor.submit(hash_batch, quick_hash_file, batch) for batch in batches]:
+                future.result()
+    return time.perf_counter() - start
+
+
+def time_command(command: List[str], repeat: int) -> Tuple[float, float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        timings.append(time.perf_counter() - start)
+    return min(timings), sum(timings) / len(timings)
+
+
+def run(args: argparse.Namespace):
+    # Same start method as main.py, every worker imports its modules itself
+    multiprocessing.set_start_method("spawn", force=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_paths = create_files(Path(tmp_dir), args.files)
+        print(f"{args.phases} phases of {args.files} files with {args.workers} workers")
+        print(f"{'pool':<20}{'seconds':>10}{'per phase':>12}")
+        per_phase = run_pool_per_phase(file_paths, args.phases, args.workers)
+        print(f"{'pool per phase':<20}{per_phase:>10.2f}{per_phase / args.phases:>12.2f}")
+        shared = run_shared_pool(file_paths, args.phases, args.workers, args.batch_size)
+        print(f"{'shared pool':<20}{shared:>10.2f}{shared / args.phases:>12.2f}")
+
+    print(f"\nProgram startup, best and mean of {args.repeat} runs")
+    main_path = Path(__file__).resolve().parent.parent / "main.py"
+    commands = {"unfrozen": [sys.executable, str(main_path), "--help"]}
+    if args.frozen:
+        # A one file build unpacks itself on every start
+        commands["frozen"] = [args.frozen, "--help"]
+    for name, command in commands.items():
+        best, mean = time_command(command, args.repeat)
+        print(f"{name:<20}{best:>10.2f}{mean:>12.2f}")
@@ -0,0 +1,494 @@
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from shutil import which
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from hasher import HashDict, READERS, DEFAULT_BLOCK_SIZE
+
+DESCRIPTION = "Run the benchmark suite on a deterministic synthetic corpus and compare it with a baseline"
+
+CLIP_SOURCES = (
+    "cellauto=rule=110:seed={seed}:size=320x240:rate=25",
+    "life=seed={seed}:size=320x240:rate=25:mold=10",
+    "testsrc2=size=320x240:rate=25",
+    "mandelbrot=size=320x240:rate=25",
+)
+# Metrics where a higher value is better, for all others lower is better
+HIGHER_IS_BETTER = ("throughput",)
+ROOT_PATH = Path(__file__).resolve().parent.parent
+SMALL_FILE_SIZE = 64 * 1024
+
+
+class Corpus(NamedTuple):
+    directory: Path
+    sparse_path: Path
+    small_paths: List[Path]
+    clip_paths: List[Path]
+    index_path: Path
+    epdb_path: Path
+    index_hashes: List[str]
+    epdb_hashes: List[str]
+
+
+class CaseResult(NamedTuple):
+    # Work done per second in unit and the seconds every single operation took
+    throughput: float
+    unit: str
+    latencies: List[float]
+    # Python memory held by the loaded structure and the peak while loading it, traced by the memory cases
+    retained_mib: Optional[float] = None
+    traced_peak_mib: Optional[float] = None
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--cases", type=str, nargs="*", help=f"Cases to run, all by default: {', '.join(CASES)}")
+    parser.add_argument("--corpus", type=str, default="bench_corpus",
+                        help="Directory of the generated corpus, reused while the corpus arguments don't change")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument("--sparse_size", type=int, default=1024, help="Size of the sparse file in MiB")
+    parser.add_argument("--small_files", type=int, default=256,
+                        help="Small files quick hashed through the worker pool")
+    parser.add_argument("--clips", type=int, default=4, help="Generated clips for phash, needs ffmpeg")
+    parser.add_argument("--clip_seconds", type=int, default=20, help="Length of the generated clips")
+    parser.add_argument("--entries", type=int, default=100_000, help="Files in the synthetic index")
+    parser.add_argument("--seasons", type=int, default=50, help="Seasons in the synthetic epdb")
+    parser.add_argument("--episodes", type=int, default=40, help="Episodes per season in the synthetic epdb")
+    parser.add_argument("--lookups", type=int, default=10_000, help="Hash lookups per lookup case")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the cases that process the whole corpus")
+    parser.add_argument("--block_size", type=int, default=DEFAULT_BLOCK_SIZE // 1024,
+                        help="Read block size in KiB of the sha256 cases")
+    parser.add_argument("--cold", action="store_true",
+                        help="Evict the sparse file from the page cache before every sha256 run (posix only)")
+    parser.add_argument("--workers", type=int, default=4, help="Workers of the worker pool case")
+    parser.add_argument("--frozen", type=str,
+                        help="PyInstaller build whose startup is timed next to the unfrozen main.py")
+    parser.add_argument("--baseline", type=str, help="Baseline json to compare with")
+    parser.add_argument("--save_baseline", type=str, help="Write the results to this baseline json")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Relative change against the baseline that counts as a regression")
+
+
+def create_sparse_file(file_path: Path, size_mib: int, seed: int):
+    # Mostly holes, a random MiB every 64 MiB so the content isn't all zeros
+    rng = random.Random(seed)
+    with open(file_path, "wb") as f:
+        f.truncate(size_mib * 2 ** 20)
+        for offset in range(0, size_mib, 64):
+            f.seek(offset * 2 ** 20)
+            f.write(rng.randbytes(2 ** 20))
+
+
+def create_small_files(paths: List[Path], seed: int):
+    rng = random.Random(seed)
+    for file_path in paths:
+        file_path.write_bytes(rng.randbytes(SMALL_FILE_SIZE))
+
+
+def create_index(file_path: Path, entries: int, seed: int):
+    rng = random.Random(seed)
+    files = {}
+    stats = {}
+    for index in range(entries):
+        file_path_string = f"/mnt/wbch/Season {index % 12 + 1:02d}/Episode {index:06d} - Some Title.mp4"
+        files[file_path_string] = {
+            "qhash": rng.randbytes(32).hex(),
+            "hash": rng.randbytes(32).hex(),
+            "phash": hex(rng.getrandbits(64)),
+        }
+        stats[file_path_string] = [rng.randrange(2 ** 31), rng.getrandbits(60), index + 1000, 2049]
+    with open(file_path, "w") as f:
+        json.dump({"files": files, "stats": stats}, f)
+
+
+def load_index(file_path: Path) -> HashDict:
+    hash_dict = HashDict(file_path)
+    hash_dict.load_dict_from_file()
+    return hash_dict
+
+
+def create_clip(file_path: Path, index: int, seconds: int, seed: int):
+    source = CLIP_SOURCES[index % len(CLIP_SOURCES)].format(seed=seed + index)
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", source, "-t", str(seconds),
+                    "-c:v", "mpeg4", "-q:v", "5", "-fflags", "+bitexact", "-flags:v", "+bitexact", str(file_path)],
+                   check=True)
+
+
+def create_epdb(file_path: Path, seasons: int, episodes: int, seed: int):
+    rng = random.Random(seed)
+
+    def create_video(name: str) -> Dict[str, Any]:
+        return {"name": name, "versions": [{"tags": tags, "suffix": "", "hashes": {
+            "hash": rng.randbytes(32).hex(),
+            "qhash": rng.randbytes(32).hex(),
+            "phash": hex(rng.getrandbits(64)),
+        }} for tags in ([], ["censored"])]}
+
+    db = {"seasons": [], "other_groups": []}
+    for season in range(1, seasons + 1):
+        db["seasons"].append({
+            "number": season,
+            "name": f"SEASON_{season}",
+            "episodes": [{**create_video(f"Episode {episode}"), "number": str(episode)}
+                         for episode in range(1, episodes + 1)],
+            "finale": create_video("Finale"),
+        })
+    db["other_groups"].append({"name": "Group",
+                               "videos": [create_video(f"Video {video}") for video in range(episodes)]})
+    with open(file_path, "w") as f:
+        json.dump(db, f)
+
+
+def load_hashes(file_path: Path, get_hashes: Callable[[Dict], List[str]]) -> List[str]:
+    with open(file_path, "r") as f:
+        return get_hashes(json.load(f))
+
+
+def create_corpus(args: argparse.Namespace) -> Corpus:
+    directory = Path(args.corpus)
+    directory.mkdir(parents=True, exist_ok=True)
+    parameters = {name: getattr(args, name) for name in
+                  ("seed", "sparse_size", "small_files", "clips", "clip_seconds", "entries", "seasons", "episodes")}
+    manifest_path = directory / "manifest.json"
+    try:
+        with open(manifest_path, "r") as f:
+            reuse = json.load(f) == parameters
+    except (OSError, json.JSONDecodeError):
+        reuse = False
+
+    sparse_path = directory / "sparse.bin"
+    small_directory = directory / "small"
+    small_paths = [small_directory / f"{index}.mp4" for index in range(args.small_files)]
+    index_path = directory / "wbch_index.json"
+    epdb_path = directory / "epdb.json"
+    clip_paths = [directory / f"clip_{index}.mp4" for index in range(args.clips)] if which("ffmpeg") else []
+    if not reuse:
+        print(f"Generating the corpus in {directory}")
+        manifest_path.unlink(missing_ok=True)
+        create_sparse_file(sparse_path, args.sparse_size, args.seed)
+        small_directory.mkdir(exist_ok=True)
+        create_small_files(small_paths, args.seed)
+        for index, clip_path in enumerate(clip_paths):
+            create_clip(clip_path, index, args.clip_seconds, args.seed)
+        create_index(index_path, args.entries, args.seed)
+        create_epdb(epdb_path, args.seasons, args.episodes, args.seed)
+        with open(manifest_path, "w") as f:
+            json.dump(parameters, f)
+    if not clip_paths:
+        print("ffmpeg not found, skipping the phash cases")
+
+    index_hashes = load_hashes(index_path, lambda index: [hashes["hash"] for hashes in index["files"].values()])
+    epdb_hashes = load_hashes(epdb_path, lambda db: [version["hashes"]["hash"]
+                                                     for season in db["seasons"]
+                                                     for episode in season["episodes"]
+                                                     for version in episode["versions"]])
+    return Corpus(directory, sparse_path, small_paths, clip_paths, index_path, epdb_path, index_hashes, epdb_hashes)
+
+
+def timed(function: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def traced_load(load: Callable[[], Any], repeat: int) -> CaseResult:
+    latencies = []
+    retained = peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        loaded = load()
+        latencies.append(time.perf_counter() - start)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del loaded
+    return CaseResult(len(latencies) / sum(latencies), "loads/s", latencies, retained / 2 ** 20, peak / 2 ** 20)
+
+
+def lookup_queries(known_hashes: List[str], count: int, seed: int) -> List[str]:
+    # Half of the lookups hit, half miss
+    rng = random.Random(seed)
+    return [rng.choice(known_hashes) if index % 2 == 0 else rng.randbytes(32).hex() for index in range(count)]
+
+
+def timed_lookups(lookup: Callable[[str], Any], queries: List[str], batch_size: int = 100) -> List[float]:
+    # A single lookup takes about as long as reading the clock, so batches are timed and averaged
+    latencies = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        latencies.append(timed(lambda: [lookup(query) for query in batch]) / len(batch))
+    return latencies
+
+
+def evict_from_page_cache(file_path: Path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with open(file_path, "rb") as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def sha256_case(reader: str) -> Callable[[Corpus, argparse.Namespace], CaseResult]:
+    def case_sha256(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+        from hasher import hash_file
+        latencies = []
+        for _ in range(args.repeat):
+            if args.cold:
+                evict_from_page_cache(corpus.sparse_path)
+            latencies.append(timed(lambda: hash_file(corpus.sparse_path, {"hash"}, args.block_size * 1024, reader)))
+        return CaseResult(args.sparse_size / (sum(latencies) / len(latencies)), "MiB/s", latencies)
+    return case_sha256
+
+
+def case_quick_hash(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    from hasher import quick_hash_file
+    latencies = [timed(lambda: quick_hash_file(corpus.sparse_path)) for _ in range(100 * args.repeat)]
+    return CaseResult(len(latencies) / sum(latencies), "files/s", latencies)
+
+
+def case_phash(corpus: Corpus, args: argparse.Namespace) -> Optional[CaseResult]:
+    from hasher import phash_file
+    if not corpus.clip_paths:
+        return None
+    latencies = [timed(lambda: phash_file(clip_path)) for clip_path in corpus.clip_paths]
+    return CaseResult(len(latencies) / sum(latencies), "clips/s", latencies)
+
+
+def case_phash_videohash2(corpus: Corpus, args: argparse.Namespace) -> Optional[CaseResult]:
+    # The reference pipeline that writes its frames to disk, what the in memory phash is measured against
+    from hasher import phash_file_videohash2
+    if not corpus.clip_paths:
+        return None
+    latencies = [timed(lambda: phash_file_videohash2(clip_path)) for clip_path in corpus.clip_paths]
+    return CaseResult(len(latencies) / sum(latencies), "clips/s", latencies)
+
+
+def case_sparse_phash(corpus: Corpus, args: argparse.Namespace) -> Optional[CaseResult]:
+    from hasher import sparse_phash_file
+    if not corpus.clip_paths:
+        return None
+    latencies = [timed(lambda: sparse_phash_file(clip_path)) for clip_path in corpus.clip_paths]
+    return CaseResult(len(latencies) / sum(latencies), "clips/s", latencies)
+
+
+def case_worker_pool(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    # Quick hash phases through one shared pool, the first phase includes starting and warming the workers
+    from hasher import quick_hash_file
+    from worker_pool import WorkerPool, hash_batch
+    jobs = [(file_path, {"qhash"}) for file_path in corpus.small_paths]
+    batches = [jobs[i:i + 16] for i in range(0, len(jobs), 16)]
+    latencies = []
+    with WorkerPool(args.workers, args.workers) as worker_pool:
+        for _ in range(args.repeat):
+            latencies.append(timed(lambda: [future.result() for future in [
+                worker_pool.io_executor.submit(hash_batch, quick_hash_file, batch) for batch in batches]]))
+    return CaseResult(len(jobs) * len(latencies) / sum(latencies), "files/s", latencies)
+
+
+def case_index_load(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    latencies = [timed(lambda: load_index(corpus.index_path)) for _ in range(args.repeat)]
+    return CaseResult(args.entries / (sum(latencies) / len(latencies)), "files/s", latencies)
+
+
+def case_index_json_memory(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    # The parsed json with hex strings in nested dicts is what the index used to keep in memory
+    return traced_load(lambda: load_hashes(corpus.index_path, lambda index: index), args.repeat)
+
+
+def case_index_memory(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    return traced_load(lambda: load_index(corpus.index_path), args.repeat)
+
+
+def case_index_lookup(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    hash_dict = load_index(corpus.index_path)
+    # The first lookup builds the reverse index, it is part of the startup and not of a lookup
+    hash_dict.find_files_by_hash(corpus.index_hashes[0], "hash")
+    queries = lookup_queries(corpus.index_hashes, args.lookups, args.seed)
+    latencies = timed_lookups(lambda query: hash_dict.find_files_by_hash(query, "hash"), queries)
+    return CaseResult(len(latencies) / sum(latencies), "lookups/s", latencies)
+
+
+def case_phash_duplicates(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    from file_management import find_duplicates_by_phash
+    hash_dict = load_index(corpus.index_path)
+    latencies = [timed(lambda: find_duplicates_by_phash(hash_dict, 8)) for _ in range(args.repeat)]
+    return CaseResult(args.entries / (sum(latencies) / len(latencies)), "files/s", latencies)
+
+
+def case_epdb_load(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    from epdb import load_db
+    latencies = [timed(lambda: load_db(corpus.epdb_path)) for _ in range(args.repeat)]
+    return CaseResult(len(corpus.epdb_hashes) / (sum(latencies) / len(latencies)), "versions/s", latencies)
+
+
+def case_epdb_memory(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    from epdb import load_db
+    return traced_load(lambda: load_db(corpus.epdb_path), args.repeat)
+
+
+def case_epdb_lookup(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    from epdb import load_db
+    db = load_db(corpus.epdb_path)
+    queries = lookup_queries(corpus.epdb_hashes, args.lookups, args.seed)
+    latencies = timed_lookups(lambda query: db.get_version_by_hash("hash", query), queries)
+    return CaseResult(len(latencies) / sum(latencies), "lookups/s", latencies)
+
+
+def time_command(command: List[str], repeat: int) -> CaseResult:
+    latencies = [timed(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                              cwd=ROOT_PATH, check=False))
+                 for _ in range(repeat)]
+    return CaseResult(len(latencies) / sum(latencies), "starts/s", latencies)
+
+
+def case_startup(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    return time_command([sys.executable, str(ROOT_PATH / "main.py"), "--help"], args.repeat)
+
+
+def case_startup_frozen(corpus: Corpus, args: argparse.Namespace) -> Optional[CaseResult]:
+    # A one file build unpacks itself on every start
+    if not args.frozen:
+        return None
+    return time_command([args.frozen, "--help"], args.repeat)
+
+
+def import_seconds(module: str) -> float:
+    # Cumulative import time of the module as reported by -X importtime, without the interpreter startup
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT_PATH,
+                            capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1_000_000
+    raise ValueError(f"{module} not found in the -X importtime output")
+
+
+def case_import_main(corpus: Corpus, args: argparse.Namespace) -> CaseResult:
+    latencies = [import_seconds("main") for _ in range(args.repeat)]
+    return CaseResult(len(latencies) / sum(latencies), "imports/s", latencies)
+
+
+CASES: Dict[str, Callable[[Corpus, argparse.Namespace], Optional[CaseResult]]] = {
+    **{f"sha256_{reader}": sha256_case(reader) for reader in READERS},
+    "quick_hash": case_quick_hash,
+    "worker_pool": case_worker_pool,
+    "phash": case_phash,
+    "phash_videohash2": case_phash_videohash2,
+    "sparse_phash": case_sparse_phash,
+    "index_load": case_index_load,
+    "index_json_memory": case_index_json_memory,
+    "index_memory": case_index_memory,
+    "index_lookup": case_index_lookup,
+    "phash_duplicates": case_phash_duplicates,
+    "epdb_load": case_epdb_load,
+    "epdb_memory": case_epdb_memory,
+    "epdb_lookup": case_epdb_lookup,
+    "startup": case_startup,
+    "startup_frozen": case_startup_frozen,
+    "import_main": case_import_main,
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def peak_rss_mib() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Kilobytes on linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def run_case(name: str, corpus: Corpus, args: argparse.Namespace) -> Optional[Dict[str, Any]]:
+    # Runs in a fresh process, so the peak RSS is the one of this case alone
+    result = CASES[name](corpus, args)
+    if result is None:
+        return None
+    return {
+        "throughput": result.throughput,
+        "unit": result.unit,
+        "p50_ms": percentile(result.latencies, 0.5) * 1000,
+        "p95_ms": percentile(result.latencies, 0.95) * 1000,
+        "p99_ms": percentile(result.latencies, 0.99) * 1000,
+        "peak_rss_mib": peak_rss_mib(),
+        "retained_mib": result.retained_mib,
+        "traced_peak_mib": result.traced_peak_mib,
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for metric in ("throughput", "p95_ms", "peak_rss_mib", "retained_mib"):
+        value = result.get(metric)
+        baseline_value = baseline.get(metric)
+        if value is None or not baseline_value:
+            continue
+        change = value / baseline_value - 1
+        if (metric in HIGHER_IS_BETTER and change < -tolerance) or \
+                (metric not in HIGHER_IS_BETTER and change > tolerance):
+            regressions.append(f"{metric} {change:+.0%}")
+    return regressions
+
+
+def format_change(value: Optional[float], baseline_value: Optional[float]) -> str:
+    if value is None or not baseline_value:
+        return "-"
+    return f"{value / baseline_value - 1:+.0%}"
+
+
+def run(args: argparse.Namespace):
+    names = args.cases or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        raise SystemExit(f"Unknown cases: {', '.join(unknown)}")
+    corpus = create_corpus(args)
+    baseline: Dict[str, Dict[str, Any]] = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    regressions: List[Tuple[str, List[str]]] = []
+    print(f"{'case':<18}{'throughput':>25}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'peak RSS':>12}"
+          f"{'retained':>12}{'vs baseline':>14}")
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            result = executor.submit(run_case, name, corpus, args).result()
+        if result is None:
+            print(f"{name:<18}{'skipped':>25}")
+            continue
+        results[name] = result
+        peak_rss = f"{result['peak_rss_mib']:.0f} MiB" if result["peak_rss_mib"] is not None else "-"
+        retained = f"{result['retained_mib']:.1f} MiB" if result.get("retained_mib") is not None else "-"
+        change = format_change(result["throughput"], baseline.get(name, {}).get("throughput"))
+        print(f"{name:<18}{result['throughput']:>13.1f} {result['unit']:<11}{result['p50_ms']:>12.3f}"
+              f"{result['p95_ms']:>12.3f}{result['p99_ms']:>12.3f}{peak_rss:>12}{retained:>12}{change:>14}")
+        if name in baseline:
+            case_regressions = compare(result, baseline[name], args.tolerance)
+            if case_regressions:
+                regressions.append((name, case_regressions))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if regressions:
+        print(f"\nRegressions beyond {args.tolerance:.0%}:")
+        for name, case_regressions in regressions:
+            print(f"  {name}: {', '.join(case_regressions)}")
+        sys.exit(1)
+    if baseline:
+        print(f"\nNo regressions beyond {args.tolerance:.0%}")
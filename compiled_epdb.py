@@ -0,0 +1,413 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Set, Iterator
+
+from model import Episode, Video, VideoVersion, Season, Group
+from model.digest import Digest, encode_digest, decode_digest
+from model.episode_db import EpisodeDb
+
+# Little endian file: header, section table, then 8 byte aligned sections. Every section is one column,
+# strings are stored once in a string table and referenced by index.
+MAGIC = b"WBCHEPDB"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+SECTION_ENTRY = struct.Struct("<24sQQ")
+NO_STRING = 0xFFFFFFFF
+SHA_SIZE = 32
+
+VIDEO_EPISODE = 0
+VIDEO_FINALE = 1
+VIDEO_MID_SEASON_FINALE = 2
+VIDEO_GROUP = 3
+
+HAS_SHA = 1
+HAS_PHASH = 2
+
+# Column name -> array typecode, "s" marks the raw sha digests
+COLUMNS = {
+    "string.offset": "I", "string.data": "B",
+    "season.number": "i", "season.name": "I", "season.video_start": "I", "season.video_count": "I",
+    "group.name": "I", "group.video_start": "I", "group.video_count": "I",
+    "video.name": "I", "video.number": "I", "video.kind": "B", "video.container": "I",
+    "video.version_start": "I", "video.version_count": "I",
+    "version.flags": "B", "version.sha": "s", "version.phash": "Q", "version.suffix": "I",
+    "version.tag_start": "I", "version.extra_start": "I",
+    "tag.string": "I", "extra.type": "I", "extra.value": "I",
+    "sha.order": "I", "phash.order": "I",
+}
+
+
+def is_compiled_db(file_path: str | Path) -> bool:
+    try:
+        with open(file_path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def encode_sha(value: str) -> Optional[bytes]:
+    # Only canonical lowercase digests are stored raw, anything else keeps its exact string
+    try:
+        digest = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return digest if len(digest) == SHA_SIZE and digest.hex() == value else None
+
+
+def encode_phash(value: str) -> Optional[int]:
+    try:
+        phash = int(value, base=16)
+    except ValueError:
+        return None
+    return phash if phash < 1 << 64 and hex(phash) == value else None
+
+
+def write_compiled_db(db: EpisodeDb, file_path: str | Path):
+    columns: Dict[str, array | bytearray] = {name: bytearray() if typecode == "s" else array(typecode)
+                                             for name, typecode in COLUMNS.items()}
+    strings: Dict[str, int] = {}
+
+    def string_id(value: str) -> int:
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    def add_video(video: Video | Episode, kind: int, container: int):
+        columns["video.name"].append(string_id(video.name))
+        columns["video.number"].append(string_id(video.number) if isinstance(video, Episode) else NO_STRING)
+        columns["video.kind"].append(kind)
+        # Seasons come first, groups are numbered after them
+        columns["video.container"].append(container)
+        columns["video.version_start"].append(len(columns["version.flags"]))
+        columns["video.version_count"].append(len(video.versions))
+        for version in video.versions:
+            flags = 0
+            sha = encode_sha(version.hashes.get("hash", ""))
+            phash = encode_phash(version.hashes.get("phash", ""))
+            if sha is not None:
+                flags |= HAS_SHA
+            if phash is not None:
+                flags |= HAS_PHASH
+            columns["version.flags"].append(flags)
+            columns["version.sha"] += sha or bytes(SHA_SIZE)
+            columns["version.phash"].append(phash or 0)
+            columns["version.suffix"].append(string_id(version.suffix))
+            columns["version.tag_start"].append(len(columns["tag.string"]))
+            columns["tag.string"].extend(string_id(tag) for tag in version.tags)
+            columns["version.extra_start"].append(len(columns["extra.type"]))
+            for hash_type, hash_value in version.hashes.items():
+                if (hash_type == "hash" and sha is not None) or (hash_type == "phash" and phash is not None):
+                    continue
+                columns["extra.type"].append(string_id(hash_type))
+                columns["extra.value"].append(string_id(hash_value))
+
+    for season_index, season in enumerate(db.seasons):
+        columns["season.number"].append(season.number)
+        columns["season.name"].append(string_id(season.name))
+        columns["season.video_start"].append(len(columns["video.name"]))
+        for episode in season.episodes:
+            add_video(episode, VIDEO_EPISODE, season_index)
+        if season.finale:
+            add_video(season.finale, VIDEO_FINALE, season_index)
+        if season.mid_season_finale:
+            add_video(season.mid_season_finale, VIDEO_MID_SEASON_FINALE, season_index)
+        columns["season.video_count"].append(len(columns["video.name"]) - columns["season.video_start"][-1])
+    for group_index, group in enumerate(db.other_groups):
+        columns["group.name"].append(string_id(group.name))
+        columns["group.video_start"].append(len(columns["video.name"]))
+        for video in group.videos:
+            add_video(video, VIDEO_GROUP, len(db.seasons) + group_index)
+        columns["group.video_count"].append(len(group.videos))
+
+    # Closing offsets, a row's range is [start[i], start[i + 1])
+    columns["version.tag_start"].append(len(columns["tag.string"]))
+    columns["version.extra_start"].append(len(columns["extra.type"]))
+    for value in strings:
+        columns["string.offset"].append(len(columns["string.data"]))
+        columns["string.data"].frombytes(value.encode("utf-8"))
+    columns["string.offset"].append(len(columns["string.data"]))
+
+    # Sorted lookup orders, ties keep db order so the first version with a hash wins like in EpisodeDb
+    version_count = len(columns["version.flags"])
+    sha = columns["version.sha"]
+    columns["sha.order"].extend(sorted(
+        (version for version in range(version_count) if columns["version.flags"][version] & HAS_SHA),
+        key=lambda version: (sha[version * SHA_SIZE:(version + 1) * SHA_SIZE], version)))
+    columns["phash.order"].extend(sorted(
+        (version for version in range(version_count) if columns["version.flags"][version] & HAS_PHASH),
+        key=lambda version: (columns["version.phash"][version], version)))
+
+    sections = []
+    offset = HEADER.size + SECTION_ENTRY.size * len(columns)
+    for name, column in columns.items():
+        if isinstance(column, array) and sys.byteorder != "little":
+            column = array(column.typecode, column)
+            column.byteswap()
+        data = bytes(column)
+        offset += -offset % 8
+        sections.append((name, offset, data))
+        offset += len(data)
+
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+        for name, offset, data in sections:
+            f.write(SECTION_ENTRY.pack(name.encode("ascii"), offset, len(data)))
+        for name, offset, data in sections:
+            f.write(bytes(offset - f.tell()))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class CompiledEpisodeDb(EpisodeDb):
+    # Read only EpisodeDb over a memory mapped compiled db. Seasons and groups are only turned into model
+    # objects when they are accessed, hash lookups bisect the sorted columns.
+    file_path: Path
+    __buffer: memoryview
+    __columns: Dict[str, memoryview | array]
+    __seasons: List[Optional[Season]]
+    __groups: List[Optional[Group]]
+    __videos: Dict[int, Tuple[Season | Group, Video | Episode]]
+
+    def __init__(self, file_path: str | Path):
+        # The lists and indexes of EpisodeDb are replaced by the lazy properties below
+        self.file_path = Path(file_path)
+        with open(self.file_path, "rb") as f:
+            self.__buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, section_count = HEADER.unpack_from(self.__buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Not a compiled epdb of version {FORMAT_VERSION}: {self.file_path}")
+
+        self.__columns = {}
+        for index in range(section_count):
+            name, offset, length = SECTION_ENTRY.unpack_from(self.__buffer, HEADER.size + index * SECTION_ENTRY.size)
+            name = name.rstrip(b"\0").decode("ascii")
+            typecode = COLUMNS.get(name)
+            if typecode is None:
+                continue
+            view = self.__buffer[offset:offset + length]
+            if typecode == "s":
+                self.__columns[name] = view
+            elif sys.byteorder == "little":
+                self.__columns[name] = view.cast(typecode)
+            else:
+                column = array(typecode, view.tobytes())
+                column.byteswap()
+                self.__columns[name] = column
+        self.__seasons = [None] * len(self.__columns["season.number"])
+        self.__groups = [None] * len(self.__columns["group.name"])
+        self.__videos = {}
+
+    @property
+    def seasons(self) -> Tuple[Season, ...]:
+        return tuple(self.__get_season(index) for index in range(len(self.__seasons)))
+
+    @property
+    def other_groups(self) -> Tuple[Group, ...]:
+        return tuple(self.__get_group(index) for index in range(len(self.__groups)))
+
+    def __string(self, string_id: int) -> str:
+        offsets = self.__columns["string.offset"]
+        return bytes(self.__columns["string.data"][offsets[string_id]:offsets[string_id + 1]]).decode("utf-8")
+
+    def __sha(self, version: int) -> bytes:
+        return self.__columns["version.sha"][version * SHA_SIZE:(version + 1) * SHA_SIZE].tobytes()
+
+    def __make_version(self, version: int) -> VideoVersion:
+        columns = self.__columns
+        video_version = VideoVersion()
+        flags = columns["version.flags"][version]
+        # Same digests HashMap would encode the hex values to
+        if flags & HAS_SHA:
+            video_version.hashes.set_digest("hash", self.__sha(version))
+        if flags & HAS_PHASH:
+            video_version.hashes.set_digest("phash", columns["version.phash"][version])
+        for extra in range(columns["version.extra_start"][version], columns["version.extra_start"][version + 1]):
+            video_version.hashes[self.__string(columns["extra.type"][extra])] = \
+                self.__string(columns["extra.value"][extra])
+        video_version.tags = [sys.intern(self.__string(columns["tag.string"][tag]))
+                              for tag in range(columns["version.tag_start"][version],
+                                               columns["version.tag_start"][version + 1])]
+        video_version.suffix = sys.intern(self.__string(columns["version.suffix"][version]))
+        return video_version
+
+    def __make_video(self, video_index: int) -> Video | Episode:
+        columns = self.__columns
+        number = columns["video.number"][video_index]
+        if number == NO_STRING:
+            video = Video()
+        else:
+            video = Episode()
+            video.number = self.__string(number)
+        video.name = self.__string(columns["video.name"][video_index])
+        start = columns["video.version_start"][video_index]
+        video.versions = tuple(self.__make_version(version)
+                               for version in range(start, start + columns["video.version_count"][video_index]))
+        return video
+
+    def __get_season(self, index: int) -> Season:
+        if self.__seasons[index] is None:
+            columns = self.__columns
+            season = Season()
+            season.number = columns["season.number"][index]
+            season.name = self.__string(columns["season.name"][index])
+            start = columns["season.video_start"][index]
+            episodes = []
+            for video_index in range(start, start + columns["season.video_count"][index]):
+                video = self.__make_video(video_index)
+                kind = columns["video.kind"][video_index]
+                if kind == VIDEO_FINALE:
+                    season.finale = video
+                elif kind == VIDEO_MID_SEASON_FINALE:
+                    season.mid_season_finale = video
+                else:
+                    episodes.append(video)
+                self.__videos[video_index] = (season, video)
+            season.episodes = tuple(episodes)
+            self.__seasons[index] = season
+        return self.__seasons[index]
+
+    def __get_group(self, index: int) -> Group:
+        if self.__groups[index] is None:
+            columns = self.__columns
+            group = Group()
+            group.name = self.__string(columns["group.name"][index])
+            start = columns["group.video_start"][index]
+            videos = []
+            for video_index in range(start, start + columns["group.video_count"][index]):
+                video = self.__make_video(video_index)
+                videos.append(video)
+                self.__videos[video_index] = (group, video)
+            group.videos = tuple(videos)
+            self.__groups[index] = group
+        return self.__groups[index]
+
+    def __get_version_tuple(self, version: int) -> Tuple[Season | Group, Video | Episode, VideoVersion]:
+        columns = self.__columns
+        video_index = bisect_left(columns["video.version_start"], version + 1) - 1
+        if video_index not in self.__videos:
+            container = columns["video.container"][video_index]
+            if container < len(self.__seasons):
+                self.__get_season(container)
+            else:
+                self.__get_group(container - len(self.__seasons))
+        container, video = self.__videos[video_index]
+        return container, video, video.versions[version - columns["video.version_start"][video_index]]
+
+    def rebuild_index(self):
+        pass
+
+    def add_season(self, season: Season):
+        raise TypeError("A compiled epdb is read only")
+
+    def add_group(self, group: Group):
+        raise TypeError("A compiled epdb is read only")
+
+    def add_episode(self, season_number: int, episode: Episode):
+        raise TypeError("A compiled epdb is read only")
+
+    def from_dict(self, dic: Dict):
+        raise TypeError("A compiled epdb is read only")
+
+    def get_season(self, season_number: int) -> Optional[Season]:
+        for index, number in enumerate(self.__columns["season.number"]):
+            if number == season_number:
+                return self.__get_season(index)
+        return None
+
+    def get_version_by_hash(self, hash_type: str,
+                            hash_value: str) -> Optional[Tuple[Season | Group, Video | Episode, VideoVersion]]:
+        if hash_value is None:
+            return None
+        columns = self.__columns
+        version = None
+        if hash_type == "hash" and (sha := encode_sha(hash_value)) is not None:
+            order = columns["sha.order"]
+            position = bisect_left(order, sha, key=self.__sha)
+            if position < len(order) and self.__sha(order[position]) == sha:
+                version = order[position]
+        elif hash_type == "phash" and (phash := encode_phash(hash_value)) is not None:
+            order = columns["phash.order"]
+            phashes = columns["version.phash"]
+            position = bisect_left(order, phash, key=lambda row: phashes[row])
+            if position < len(order) and phashes[order[position]] == phash:
+                version = order[position]
+        if version is None:
+            version = self.__find_extra_hash(hash_type, hash_value)
+        return self.__get_version_tuple(version) if version is not None else None
+
+    def __find_extra_hash(self, hash_type: str, hash_value: str) -> Optional[int]:
+        # Hashes outside the sha and phash columns are rare, they are scanned in db order
+        columns = self.__columns
+        for extra in range(len(columns["extra.type"])):
+            if self.__string(columns["extra.type"][extra]) == hash_type and \
+                    self.__string(columns["extra.value"][extra]) == hash_value:
+                return bisect_left(columns["version.extra_start"], extra + 1) - 1
+        return None
+
+    def __iter_digests(self, hash_type: str) -> Iterator[Tuple[int, Digest]]:
+        # Version and digest of every version with the hash type, straight from the columns
+        columns = self.__columns
+        if hash_type == "hash":
+            for version in columns["sha.order"]:
+                yield version, self.__sha(version)
+        elif hash_type == "phash":
+            for version in columns["phash.order"]:
+                yield version, columns["version.phash"][version]
+        # Only a few hash types are stored as extras, their names are decoded once each
+        type_names: Dict[int, str] = {}
+        for extra, type_id in enumerate(columns["extra.type"]):
+            if type_id not in type_names:
+                type_names[type_id] = self.__string(type_id)
+            if type_names[type_id] == hash_type:
+                version = bisect_left(columns["version.extra_start"], extra + 1) - 1
+                yield version, encode_digest(self.__string(columns["extra.value"][extra]))
+
+    def get_hash_values(self, hash_type: str) -> Set[str]:
+        return {decode_digest(digest) for _, digest in self.__iter_digests(hash_type)}
+
+    def count_versions(self, *hash_types: str) -> int:
+        versions = set(range(len(self.__columns["version.flags"])))
+        for hash_type in hash_types:
+            versions.intersection_update(version for version, _ in self.__iter_digests(hash_type))
+        return len(versions)
+
+    def get_season_positions(self, hash_type: str) -> Dict[Digest, int]:
+        columns = self.__columns
+        positions = {}
+        for version, digest in self.__iter_digests(hash_type):
+            container = columns["video.container"][bisect_left(columns["video.version_start"], version + 1) - 1]
+            # Groups are numbered after the seasons
+            if container < len(self.__seasons):
+                positions[digest] = container
+        return positions
+
+    def __repr__(self):
+        return f"CompiledEpisodeDb: {len(self.__seasons)} seasons, {len(self.__groups)} other groups"
+
+
+if __name__ == "__main__":
+    from epdb import load_db
+
+    parser = argparse.ArgumentParser(description="Compile an epdb json into the binary epdb format")
+    parser.add_argument("source", type=str, help="epdb json to compile")
+    parser.add_argument("target", type=str, help="Path of the compiled epdb")
+    args = parser.parse_args()
+    source_db = load_db(args.source)
+    if source_db is None:
+        sys.exit(1)
+    write_compiled_db(source_db, args.target)
+    if CompiledEpisodeDb(args.target) != source_db:
+        print(f"Compiled epdb differs from {args.source}")
+        sys.exit(1)
+    print(f"Compiled {args.source} ({os.path.getsize(args.source)} bytes) to {args.target} "
+          f"({os.path.getsize(args.target)} bytes)")
@@ -1,30 +1,85 @@
 import os
+import sys
 import json
+import struct
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Set, NamedTuple, TextIO
 
-import requests as re
-
-from model import Episode, Video
+from model import Episode, Video, VideoVersion, Season, Group
 from model.episode_db import EpisodeDb
+from model.digest import Digest, encode_digest
+from compiled_epdb import CompiledEpisodeDb, is_compiled_db
 from hasher import HashDict
 from logger import logger
+from phash_index import PhashIndex
 
 
-def download_epdb(base_path: str | Path) -> Optional[Path]:
-    if not isinstance(base_path, Path):
-        base_path = Path(base_path)
-    url = "https://raw.githubusercontent.com/vanishedbydefa/WBCH-decider/refs/heads/main/epdb_new.json"
-    resp = re.get(url, timeout=10)
-    if resp.status_code == 200:
-        filename = base_path / os.path.basename(url)
-        with open(filename, "wb") as f:
-            f.write(resp.content)
-        logger.info(f"epdb downloaded and saved to: {filename}")
-        return filename
-    else:
+EPDB_URL = "https://raw.githubusercontent.com/vanishedbydefa/WBCH-decider/refs/heads/main/epdb_new.json"
+
+
+def load_download_metadata(metadata_path: Path, url: str) -> Dict[str, str]:
+    try:
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return metadata if metadata.get("url") == url else {}
+
+
+def write_file_atomic(file_path: Path, content: bytes):
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def download_epdb(file_path: str | Path, url: str = EPDB_URL) -> Optional[Path]:
+    # Imported on demand, requests alone takes longer to import than the rest of the program
+    import requests as re
+    file_path = Path(file_path)
+    # The validators of the last download, an unchanged db is answered with 304 and not sent again
+    metadata_path = file_path.with_name(file_path.name + ".meta")
+    metadata = load_download_metadata(metadata_path, url) if file_path.exists() else {}
+    headers = {}
+    if metadata.get("etag"):
+        headers["If-None-Match"] = metadata["etag"]
+    if metadata.get("last_modified"):
+        headers["If-Modified-Since"] = metadata["last_modified"]
+
+    cached_path = file_path if file_path.exists() else None
+    try:
+        resp = re.get(url, headers=headers, timeout=10)
+    except re.RequestException as e:
+        logger.error(f"Failed to download epdb, using the cached one: {e}")
+        return cached_path
+    if resp.status_code == 304:
+        logger.info(f"epdb is up to date: {file_path}")
+        return file_path
+    if resp.status_code != 200:
         logger.error(f"Failed to download epdb. Status code: {resp.status_code}")
-        return None
+        return cached_path
+    try:
+        json.loads(resp.content)
+    except ValueError as e:
+        logger.error(f"Downloaded epdb is not valid json, using the cached one: {e}")
+        return cached_path
+
+    write_file_atomic(file_path, resp.content)
+    write_file_atomic(metadata_path, json.dumps({
+        "url": url,
+        "etag": resp.headers.get("ETag", ""),
+        "last_modified": resp.headers.get("Last-Modified", "")
+    }).encode())
+    logger.info(f"epdb downloaded and saved to: {file_path}")
+    return file_path
+
+
+def update_and_load_db(file_path: str | Path, update: bool = False, url: str = EPDB_URL) -> Optional[EpisodeDb]:
+    if update:
+        download_epdb(file_path, url)
+    return load_db(file_path)
 
 
 def load_db(file_path: Path | str) -> Optional[EpisodeDb]:
@@ -35,6 +90,13 @@ def load_db(file_path: Path | str) -> Optional[EpisodeDb]:
     if not file_path.is_file():
         logger.error(f"Path is not a file: {file_path}")
 
+    if is_compiled_db(file_path):
+        try:
+            return CompiledEpisodeDb(file_path)
+        except (ValueError, KeyError, struct.error) as e:
+            logger.error(f"Error while reading compiled db: {file_path}, Error: {e}")
+            return None
+
     try:
         with open(file_path, 'r') as f:
             epdb_dict = json.load(f)
@@ -47,11 +109,7 @@ def load_db(file_path: Path | str) -> Optional[EpisodeDb]:
     return epdb
 
 
-def process_episode(episode: Episode | Video, season: int, episode_type: str, hash_to_file_dict: Dict[str, str],
-                    root_folder: Path) -> Tuple[int, int, List[str]]:
-    if not episode or not episode.versions:
-        return 0, 0, []
-
+def format_episode_code(episode: Episode | Video, season: int, episode_type: str) -> str:
     # Determine episode number format
     if episode_type == 'finale':
         episode_number = 'SF'
@@ -62,78 +120,294 @@ def process_episode(episode: Episode | Video, season: int, episode_type: str, ha
         if episode_number.isdigit():
             episode_number = f"{int(episode_number):02d}"
 
-    episode_string = f"S{season:02d}E{episode_number} - {episode.name}"
+    return f"S{season:02d}E{episode_number}"
+
+
+def format_episode_string(episode: Episode | Video, season: int, episode_type: str) -> str:
+    return f"{format_episode_code(episode, season, episode_type)} - {episode.name}"
+
+
+def format_video_string(container: Season | Group, video: Video | Episode) -> str:
+    if isinstance(container, Group):
+        return f"{container.name} - {video.name}"
+    if video is container.finale:
+        return format_episode_string(video, container.number, 'finale')
+    if video is container.mid_season_finale:
+        return format_episode_string(video, container.number, 'msf')
+    return format_episode_string(video, container.number, 'regular')
+
+
+def format_tag_string(version: VideoVersion) -> str:
+    return " ".join(version.tags) or "Normal"
+
+
+def find_fuzzy_matches(db: EpisodeDb, hashes: HashDict, max_distance: int) -> Dict[str, Tuple[str, int]]:
+    # Pairs db versions without an exact match with local files unknown to the db by phash distance.
+    # Closest pairs are taken first and every version and file is used at most once.
+    version_index = PhashIndex()
+    for _, _, version in db.get_versions():
+        version_hash = version.hashes.get("hash")
+        version_phash = version.hashes.get("phash")
+        if version_hash and version_phash and not hashes.find_file_by_hash(version_hash, "hash") \
+                and version_hash not in version_index:
+            version_index.add(version_hash, version_phash)
+
+    candidates: List[Tuple[int, str, str]] = []
+    for file, file_phash in hashes.get_hash_type_dict("phash").items():
+        if db.get_version_by_hash("hash", hashes.get_hash(file, "hash")):
+            continue
+        for version_hash, distance in version_index.query(file_phash, max_distance):
+            candidates.append((distance, file, version_hash))
+
+    fuzzy_hash_to_file_dict: Dict[str, Tuple[str, int]] = {}
+    matched_files = set()
+    for distance, file, version_hash in sorted(candidates):
+        if version_hash in fuzzy_hash_to_file_dict or file in matched_files:
+            continue
+        fuzzy_hash_to_file_dict[version_hash] = (file, distance)
+        matched_files.add(file)
+    return fuzzy_hash_to_file_dict
+
+
+def match_version(version: VideoVersion, hashes: HashDict,
+                  fuzzy_hash_to_file_dict: Dict[str, Tuple[str, int]]) -> Tuple[str, List[Path], Optional[int]]:
+    # "exact" with all files of the version, "fuzzy" with the closest file by phash, or "missing"
+    version_hash = version.hashes.get("hash")
+    version_files = hashes.find_files_by_hash(version_hash, "hash") if version_hash else []
+    if version_files:
+        return "exact", version_files, None
+    if version_hash in fuzzy_hash_to_file_dict:
+        version_file, distance = fuzzy_hash_to_file_dict[version_hash]
+        return "fuzzy", [Path(version_file)], distance
+    return "missing", [], None
+
+
+def process_episode(episode: Episode | Video, season: int, episode_type: str, hashes: HashDict, root_folder: Path,
+                    fuzzy_hash_to_file_dict: Optional[Dict[str, Tuple[str, int]]] = None
+                    ) -> Tuple[int, int, int, List[str]]:
+    if not episode or not episode.versions:
+        return 0, 0, 0, []
+
+    fuzzy_hash_to_file_dict = fuzzy_hash_to_file_dict or {}
+    episode_string = format_episode_string(episode, season, episode_type)
     output_lines = []
     found_count = 0
+    fuzzy_count = 0
     total_count = len(episode.versions)
 
     if not episode.versions:
         output_lines.append(f"  ⚠️  '{episode_string}' - No hash available")
-        return 0, 0, output_lines
+        return 0, 0, 0, output_lines
 
     output_lines.append(f"  📺 '{episode_string}'")
     for version in episode.versions:
-        episode_hash = version.hashes.get("hash")
-        tag_string = " ".join(version.tags) or "Normal"
-
-        if episode_hash in hash_to_file_dict:
+        tag_string = format_tag_string(version)
+        match_type, episode_files, distance = match_version(version, hashes, fuzzy_hash_to_file_dict)
+        if match_type == "exact":
             found_count += 1
-            episode_file = hash_to_file_dict[episode_hash]
-            episode_file = Path(episode_file).relative_to(root_folder)
+            episode_file = episode_files[0].relative_to(root_folder)
             output_lines.append(f"\t\t✅ Version '{tag_string}' - Found at '{episode_file}'")
+            for duplicate_file in episode_files[1:]:
+                output_lines.append(f"\t\t\t♻️ Duplicate at '{duplicate_file.relative_to(root_folder)}'")
+        elif match_type == "fuzzy":
+            found_count += 1
+            fuzzy_count += 1
+            episode_file = episode_files[0].relative_to(root_folder)
+            output_lines.append(f"\t\t🔶 Version '{tag_string}' - Fuzzy match at '{episode_file}' "
+                                f"(phash distance {distance})")
         else:
             output_lines.append(f"\t\t❌ Version '{tag_string}' - Missing")
 
-    return found_count, total_count, output_lines
+    return found_count, fuzzy_count, total_count, output_lines
+
+
+class SeasonResult(NamedTuple):
+    number: int
+    found: int
+    fuzzy: int
+    total: int
+    lines: List[str]
+
+
+def process_season(season_data: Season, hashes: HashDict, root_folder: Path,
+                   fuzzy_hash_to_file_dict: Optional[Dict[str, Tuple[str, int]]] = None) -> SeasonResult:
+    season = season_data.number
+    season_found = 0
+    season_fuzzy = 0
+    season_total = 0
+    lines = []
+    # Regular episodes, then the season finale and the mid-season finale
+    episodes = [(episode, 'regular') for episode in season_data.episodes]
+    episodes += [(season_data.finale, 'finale'), (season_data.mid_season_finale, 'msf')]
+    for episode, episode_type in episodes:
+        found, fuzzy, total, episode_lines = process_episode(
+            episode, season, episode_type, hashes, root_folder, fuzzy_hash_to_file_dict
+        )
+        season_found += found
+        season_fuzzy += fuzzy
+        season_total += total
+        lines.append("\n".join(episode_lines))
+    return SeasonResult(season, season_found, season_fuzzy, season_total, lines)
+
+
+class ReportCache:
+    # Season results of the last report for one db. Seasons are only processed again once a hash of one
+    # of their versions changed, an unchanged index generation reuses all of them.
+    db: EpisodeDb
+    hashes: HashDict
+    __season_by_hash: Dict[Digest, int]
+    __results: Dict[int, SeasonResult]
+    __dirty_seasons: Set[int]
+    __fuzzy_hash_to_file_dict: Optional[Dict[str, Tuple[str, int]]]
+    __fuzzy_dirty: bool
+    __key: Optional[Tuple[Path, Optional[int], int]]
+
+    def __init__(self, db: EpisodeDb, hashes: HashDict):
+        self.db = db
+        self.hashes = hashes
+        self.__season_by_hash = db.get_season_positions("hash")
+        self.__results = {}
+        self.__dirty_seasons = set()
+        self.__fuzzy_hash_to_file_dict = None
+        self.__fuzzy_dirty = True
+        self.__key = None
+        hashes.add_change_listener(self.__on_change)
+
+    def __on_change(self, hash_type: str, digest: Digest):
+        if hash_type == "hash":
+            index = self.__season_by_hash.get(digest)
+            if index is not None:
+                self.__dirty_seasons.add(index)
+        if hash_type in ("hash", "phash"):
+            # Fuzzy pairs are assigned across the whole collection
+            self.__fuzzy_dirty = True
+
+    def get_season_results(self, root_folder: Path, fuzzy_distance: Optional[int] = None) -> List[SeasonResult]:
+        key = (root_folder, fuzzy_distance, self.hashes.generation)
+        if self.__key is None or self.__key[:2] != key[:2]:
+            self.__results = {}
+            self.__fuzzy_hash_to_file_dict = None
+        elif self.__key == key:
+            return [self.__results[index] for index in range(len(self.db.seasons))]
+        self.__key = key
 
+        fuzzy_hash_to_file_dict = {}
+        if fuzzy_distance is not None:
+            if self.__fuzzy_dirty or self.__fuzzy_hash_to_file_dict is None:
+                fuzzy_hash_to_file_dict = find_fuzzy_matches(self.db, self.hashes, fuzzy_distance)
+                old_fuzzy_hash_to_file_dict = self.__fuzzy_hash_to_file_dict or {}
+                for version_hash in old_fuzzy_hash_to_file_dict.keys() | fuzzy_hash_to_file_dict.keys():
+                    if old_fuzzy_hash_to_file_dict.get(version_hash) != fuzzy_hash_to_file_dict.get(version_hash):
+                        index = self.__season_by_hash.get(encode_digest(version_hash))
+                        if index is not None:
+                            self.__dirty_seasons.add(index)
+                self.__fuzzy_hash_to_file_dict = fuzzy_hash_to_file_dict
+            fuzzy_hash_to_file_dict = self.__fuzzy_hash_to_file_dict
+        self.__fuzzy_dirty = False
 
-def report(db: EpisodeDb, hashes: HashDict, root_folder: Path):
-    # Create a dictionary for quick lookup of available files (hash → file path)
-    hash_to_file_dict: Dict[str, str] = {hashes.get_hash(file, "hash"): file for file in
-                                         hashes.get_file_names_in_dict()}
+        for index, season_data in enumerate(self.db.seasons):
+            if index not in self.__results or index in self.__dirty_seasons:
+                self.__results[index] = process_season(season_data, self.hashes, root_folder,
+                                                       fuzzy_hash_to_file_dict)
+        self.__dirty_seasons.clear()
+        return [self.__results[index] for index in range(len(self.db.seasons))]
+
+    def get_fuzzy_matches(self, root_folder: Path, fuzzy_distance: Optional[int] = None) -> Dict[str, Tuple[str, int]]:
+        # The pairs of the current report, only matched again when the hashes changed
+        self.get_season_results(root_folder, fuzzy_distance)
+        return self.__fuzzy_hash_to_file_dict or {}
+
+
+def report(db: EpisodeDb, hashes: HashDict, root_folder: Path, fuzzy_distance: Optional[int] = None,
+           summary: bool = False, cache: Optional[ReportCache] = None):
+    # Files are looked up by hash in the reverse index of the HashDict.
+    # Re-encoded or re-muxed copies are matched by phash as a fallback
+    if cache is not None:
+        season_results = cache.get_season_results(root_folder, fuzzy_distance)
+    else:
+        fuzzy_hash_to_file_dict = find_fuzzy_matches(db, hashes, fuzzy_distance) if fuzzy_distance is not None else {}
+        season_results = [process_season(season_data, hashes, root_folder, fuzzy_hash_to_file_dict)
+                          for season_data in db.seasons]
     total_episodes = 0
     found_episodes = 0
+    fuzzy_episodes = 0
 
-    print("\n📢  WBCH Collection Report  📢\n")
+    # Written at once, many small prints are slow, especially on Windows consoles
+    output = ["\n📢  WBCH Collection Report  📢\n"]
+    for result in season_results:
+        if not summary:
+            output.append(f"🎬 Season {result.number}\n" + "-" * 40)
+            output.extend(result.lines)
+        fuzzy_string = f" ({result.fuzzy} fuzzy)" if result.fuzzy else ""
+        output.append(f"📊 Season {result.number}: Found {result.found}/{result.total} episodes{fuzzy_string}\n")
 
-    for season_data in db.seasons:
-        season = season_data.number
-        season_found = 0
-        season_total = 0
+        total_episodes += result.total
+        found_episodes += result.found
+        fuzzy_episodes += result.fuzzy
 
-        print(f"🎬 Season {season}\n" + "-" * 40)
+    output.append("📋 Final Report")
+    output.append(f"📀 Total Episodes Found: {found_episodes}/{total_episodes}")
+    if fuzzy_episodes:
+        output.append(f"🔶 Fuzzy Matches: {fuzzy_episodes}")
+    output.append(
+        f"✅ Completion: {found_episodes / total_episodes:.2%}\n" if total_episodes > 0 else "⚠️ No episodes in database.")
 
-        # Process regular episodes
-        for episode in season_data.episodes:
-            found, total, lines = process_episode(
-                episode, season, 'regular', hash_to_file_dict, root_folder
-            )
-            season_found += found
-            season_total += total
-            print("\n".join(lines))
+    output.extend(format_duplicates(hashes, root_folder, summary))
+    sys.stdout.write("\n".join(output) + "\n")
+    sys.stdout.flush()
 
-        # Process season finale
-        found, total, lines = process_episode(
-            season_data.finale, season, 'finale', hash_to_file_dict, root_folder
-        )
-        season_found += found
-        season_total += total
-        print("\n".join(lines))
 
-        # Process mid-season finale
-        found, total, lines = process_episode(
-            season_data.mid_season_finale, season, 'msf', hash_to_file_dict, root_folder
-        )
-        season_found += found
-        season_total += total
-        print("\n".join(lines))
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
 
-        print(f"📊 Season {season}: Found {season_found}/{season_total} episodes\n")
 
-        total_episodes += season_total
-        found_episodes += season_found
+def format_duplicates(hashes: HashDict, root_folder: Path, summary: bool = False) -> List[str]:
+    duplicates = hashes.get_duplicates("hash")
+    if not duplicates:
+        return []
 
-    print("📋 Final Report")
-    print(f"📀 Total Episodes Found: {found_episodes}/{total_episodes}")
-    print(
-        f"✅ Completion: {found_episodes / total_episodes:.2%}\n" if total_episodes > 0 else "⚠️ No episodes in database.")
+    lines = [] if summary else ["♻️  Exact Duplicates\n" + "-" * 40]
+    total_wasted = 0
+    duplicate_files = 0
+    for file_paths in sorted(duplicates.values()):
+        # All copies have the same size, every copy but one is wasted space
+        file_stats = [hashes.get_file_stat(file_path) for file_path in file_paths]
+        file_size = next((file_stat.size for file_stat in file_stats if file_stat), 0)
+        wasted = file_size * (len(file_paths) - 1)
+        total_wasted += wasted
+        duplicate_files += len(file_paths)
+        if summary:
+            continue
+        lines.append(f"  ♻️ {len(file_paths)} copies of {format_size(file_size)}, {format_size(wasted)} wasted")
+        for file_path in file_paths:
+            lines.append(f"\t\t'{Path(file_path).relative_to(root_folder)}'")
+    lines.append(f"💾 {duplicate_files} files in {len(duplicates)} groups of duplicates waste "
+                 f"{format_size(total_wasted)}\n")
+    return lines
+
+
+def report_phash_matches(db: EpisodeDb, hashes: HashDict, root_folder: Path, max_distance: int,
+                         output: Optional[TextIO] = None):
+    # numpy is only needed for the vectorized phash comparison
+    from phash_matrix import PhashMatrix
+
+    files = PhashMatrix.from_hash_dict(hashes, "phash")
+    versions = PhashMatrix.from_episode_db(db, "phash")
+    matches = files.best_matches(versions, max_distance)
+
+    print(f"\n🔍  Closest epdb version per file (phash distance <= {max_distance})  🔍\n", file=output)
+    matched_count = 0
+    for file, match in sorted(zip(files.keys, matches), key=lambda file_match: file_match[0]):
+        file = Path(file).relative_to(root_folder)
+        if match is None:
+            print(f"  ❓ '{file}' - No match", file=output)
+            continue
+        matched_count += 1
+        (container, video, version), distance = match
+        print(f"  🔗 '{file}' ≈ '{format_video_string(container, video)}' "
+              f"Version '{format_tag_string(version)}' (distance {distance})", file=output)
+    print(f"📊 Matched {matched_count}/{len(files)} files by phash\n", file=output)
@@ -1,73 +1,187 @@
+import os
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
 from pathlib import Path
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Optional, Iterable, Iterator, Tuple
 
 from hasher import HashDict
+from logger import logger
+from phash_index import PhashIndex, phash_to_int, hamming_distance
+
+VIDEO_SUFFIXES = frozenset({".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm", ".m4v"})
+# Our own index files, unfinished downloads and the recycle bins and thumbnail dirs of NAS systems
+DEFAULT_EXCLUDE_PATTERNS = ("wbch_index.json*", "*.tmp", "*.part", "@eaDir", "#recycle", "$RECYCLE.BIN",
+                            "System Volume Information", ".Trash-*")
 
 
 def calculate_phash_distance(phash_1: str, phash_2: str) -> float:
     if phash_1 is None or phash_2 is None:
         return 0.0
 
-    iphash_1 = int(phash_1, base=16)
-    iphash_2 = int(phash_2, base=16)
-
-    xor_result = iphash_1 ^ iphash_2
-    distance = bin(xor_result).count('1')
-
-    return distance
+    return hamming_distance(phash_to_int(phash_1), phash_to_int(phash_2))
 
 
-def find_duplicates_by_phash(hash_dict: HashDict, distance: int) -> Dict[str, List[str]]:
-    phash_dict: Dict[str, str] = hash_dict.get_hash_type_dict("phash")
+def find_duplicates_by_phash(hash_dict: HashDict, distance: int,
+                             phash_index: Optional[PhashIndex] = None) -> Dict[str, List[str]]:
+    if phash_index is None:
+        phash_index = PhashIndex.from_hash_dict(hash_dict, "phash")
     duplicates: Dict[str, List[str]] = defaultdict(list)
-    found_duplicates_indices: Set[int] = set()
-    files: List[str] = list(phash_dict.keys())
+    found_duplicates: Set[str] = set()
+    files: List[str] = phash_index.keys()
 
-    for file_idx in range(len(files)):
-        if file_idx in found_duplicates_indices:
+    # Files closer than distance are grouped with the first file of the group
+    neighbours: Dict[str, List[str]] = defaultdict(list)
+    for file_path, other_file_path, _ in phash_index.find_pairs(distance - 1):
+        neighbours[file_path].append(other_file_path)
+
+    for file_path in files:
+        if file_path in found_duplicates:
             continue
 
-        file_path: str = files[file_idx]
         duplicates[file_path].append(file_path)
-        hash_value = phash_dict[files[file_idx]]
-        for other_file_idx in range(file_idx, len(files)):
-            if file_idx == other_file_idx or other_file_idx in found_duplicates_indices:
-                continue
-
-            other_hash_value = phash_dict[files[other_file_idx]]
-            if not calculate_phash_distance(hash_value, other_hash_value) < distance:
+        for other_file_path in neighbours[file_path]:
+            if other_file_path in found_duplicates:
                 continue
 
-            other_file_path: str = files[other_file_idx]
-
             duplicates[file_path].append(other_file_path)
             duplicates[other_file_path] = duplicates[file_path]
-            found_duplicates_indices.add(other_file_idx)
+            found_duplicates.add(other_file_path)
 
     return duplicates
 
 
-def find_duplicates_for_file_by_phash(hash_dict: HashDict, file_path: str, distance: int):
-    duplicates = find_duplicates_by_phash(hash_dict, distance)
-    for file, dupes in duplicates.items():
-        if file == file_path:
-            return dupes
-    return []
-
-
-def find_files(base_path: str | Path) -> List[Path]:
-    def is_video_file(file):
-        suffix = Path(file).suffix.lower()
-        return suffix in [".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm", ".m4v"]
-
-    files = []
-    if not isinstance(base_path, Path):
-        base_path = Path(base_path)
-    for root, _, files_in_dir in base_path.walk():
-        for name in files_in_dir:
-            file_path = root/name
-            if not is_video_file(file_path):
+def find_duplicates_for_file_by_phash(hash_dict: HashDict, file_path: str, distance: int,
+                                      phash_index: Optional[PhashIndex] = None) -> List[str]:
+    file_path = str(file_path)
+    if phash_index is None:
+        phash_index = PhashIndex.from_hash_dict(hash_dict, "phash")
+    phash = phash_index.get_phash(file_path)
+    if phash is None:
+        return []
+    dupes = [file_path]
+    for other_file_path, _ in phash_index.query(phash, distance - 1):
+        if other_file_path != file_path:
+            dupes.append(other_file_path)
+    return dupes
+
+
+def is_video_file(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in VIDEO_SUFFIXES
+
+
+def is_excluded(name: str, relative_path: str, exclude_patterns: Iterable[str]) -> bool:
+    return any(fnmatch(name, pattern) or fnmatch(relative_path, pattern) for pattern in exclude_patterns)
+
+
+def scan_directory(directory: str, relative_directory: str, exclude_patterns: Tuple[str, ...],
+                   follow_symlinks: bool) -> Tuple[List[os.DirEntry], List[Tuple[str, str]]]:
+    files: List[os.DirEntry] = []
+    directories: List[Tuple[str, str]] = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                if is_excluded(entry.name, relative_path, exclude_patterns):
+                    continue
+                if not follow_symlinks and entry.is_symlink():
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        directories.append((entry.path, relative_path))
+                    elif is_video_file(entry.name):
+                        # Stat in the worker thread, the result is cached on the entry
+                        entry.stat(follow_symlinks=follow_symlinks)
+                        files.append(entry)
+                except OSError as e:
+                    logger.warn(f"Skipping {entry.path}: {e}")
+    except OSError as e:
+        logger.warn(f"Can't read directory {directory}: {e}")
+    return files, directories
+
+
+def walk_files(base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+               follow_symlinks: bool = False, num_workers: int = 8) -> Iterator[os.DirEntry]:
+    # Directories are scanned concurrently, which hides the latency of network mounts.
+    # Video files are yielded as soon as their directory has been read.
+    exclude_patterns = tuple(exclude_patterns)
+    visited_directories: Set[Tuple[int, int]] = set()
+    if follow_symlinks:
+        base_stat = os.stat(base_path)
+        visited_directories.add((base_stat.st_dev, base_stat.st_ino))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending: Set[Future] = {executor.submit(scan_directory, str(base_path), "", exclude_patterns,
+                                                follow_symlinks)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                for directory, relative_directory in directories:
+                    if follow_symlinks:
+                        # Symlinked directories can form loops
+                        try:
+                            directory_stat = os.stat(directory)
+                        except OSError:
+                            continue
+                        if (directory_stat.st_dev, directory_stat.st_ino) in visited_directories:
+                            continue
+                        visited_directories.add((directory_stat.st_dev, directory_stat.st_ino))
+                    pending.add(executor.submit(scan_directory, directory, relative_directory, exclude_patterns,
+                                                follow_symlinks))
+                yield from files
+
+
+class FileStream:
+    # Walks the collection once, iterating again replays the files found so far and continues the walk.
+    # Lets several hashing stages share one walk while the first stage starts before the walk is done.
+    __entries: List[os.DirEntry]
+    __walker: Optional[Iterator[os.DirEntry]]
+    __condition: threading.Condition
+    __thread: Optional[threading.Thread]
+
+    def __init__(self, base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+                 follow_symlinks: bool = False, num_workers: int = 8):
+        self.__entries = []
+        self.__walker = walk_files(base_path, exclude_patterns, follow_symlinks, num_workers)
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def start(self):
+        # Walks on a background thread from now on, so the walk runs while the index and db are loaded
+        if self.__thread is None and self.__walker is not None:
+            self.__thread = threading.Thread(target=self.__walk, daemon=True)
+            self.__thread.start()
+
+    def __walk(self):
+        try:
+            for entry in self.__walker:
+                with self.__condition:
+                    self.__entries.append(entry)
+                    self.__condition.notify_all()
+        finally:
+            with self.__condition:
+                self.__walker = None
+                self.__condition.notify_all()
+
+    def __iter__(self) -> Iterator[os.DirEntry]:
+        index = 0
+        while True:
+            if index < len(self.__entries):
+                yield self.__entries[index]
+                index += 1
+                continue
+            if self.__thread is not None:
+                with self.__condition:
+                    while index >= len(self.__entries) and self.__walker is not None:
+                        self.__condition.wait()
+                if index >= len(self.__entries):
+                    return
                 continue
-            files.append(file_path)
-    return files
+            if self.__walker is None:
+                return
+            entry = next(self.__walker, None)
+            if entry is None:
+                self.__walker = None
+                return
+            self.__entries.append(entry)
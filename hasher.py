@@ -1,178 +1,681 @@
-from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from collections import Counter
 import json
+import mmap
+import sys
+import time
 from pathlib import Path
-from typing import List, Dict, Optional, Callable, Tuple
+from typing import List, Dict, Optional, Callable, Tuple, NamedTuple, Set, Iterable, BinaryIO, Iterator
 
 from logger import logger
+from model.digest import Digest, HashMap, encode_digest, decode_digest
+from model.episode_db import EpisodeDb
 import os
 
 
+class FileStat(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+
+    @classmethod
+    def from_stat_result(cls, stat_result: os.stat_result) -> "FileStat":
+        return cls(stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_dev)
+
+    @classmethod
+    def from_path(cls, file_path: str | Path) -> "FileStat":
+        return cls.from_stat_result(os.stat(file_path))
+
+    @classmethod
+    def from_dir_entry(cls, entry: os.DirEntry) -> "FileStat":
+        # Windows leaves inode and device of scandir results empty
+        if os.name == "nt":
+            return cls.from_path(entry.path)
+        return cls.from_stat_result(entry.stat())
+
+
 class HashDict:
-    __hash_dict: Dict[str, Dict[str, str]]
+    # hash type -> file path -> digest. One map per hash type instead of a dict per file keeps large
+    # indexes small, hex strings only exist in the json files.
+    __hash_dict: Dict[str, Dict[str, Digest]]
+    # hash type -> digest -> path, or a set of paths once several files share a digest.
+    # Built on the first lookup of a hash type and kept up to date from then on.
+    __reverse_index: Dict[str, Dict[Digest, str | Set[str]]]
+    __stat_dict: Dict[str, FileStat]
+    __stat_index: Dict[FileStat, str]
+    __journal_buffer: List[str]
+    __journal_length: int
+    # Called with the hash type and digest of every hash that is set or removed
+    __change_listeners: List[Callable[[str, Digest], None]]
+    # Counts the changes of the hashes, equal generations mean equal hashes
+    generation: int
     json_path: Path
+    journal_path: Path
+    journal_batch_size: int
+    compaction_threshold: int
 
-    def __init__(self, json_path: str | Path):
+    def __init__(self, json_path: str | Path, journal_batch_size: int = 64, compaction_threshold: int = 10000):
         if not isinstance(json_path, Path):
             json_path = Path(json_path)
         self.json_path = json_path
+        # Changes since the last snapshot are appended here and replayed on load
+        self.journal_path = json_path.with_name(json_path.name + ".journal")
+        self.journal_batch_size = journal_batch_size
+        self.compaction_threshold = compaction_threshold
         self.__hash_dict = {}
+        self.__reverse_index = {}
+        self.__stat_dict = {}
+        self.__stat_index = {}
+        self.__journal_buffer = []
+        self.__journal_length = 0
+        self.__change_listeners = []
+        self.generation = 0
+
+    def add_change_listener(self, listener: Callable[[str, Digest], None]):
+        self.__change_listeners.append(listener)
+
+    def __changed(self, hash_type: str, digest: Digest):
+        self.generation += 1
+        for listener in self.__change_listeners:
+            listener(hash_type, digest)
 
     def load_dict_from_file(self):
-        if not self.json_path.exists():
+        if not self.json_path.exists() and not self.journal_path.exists():
             logger.warn("No index found")
             return
 
-        with open(self.json_path, "r") as f:
-            wbch_files = json.load(f)
+        if self.json_path.exists():
+            with open(self.json_path, "r") as f:
+                wbch_files = json.load(f)
+
+            # Old indexes are a flat {path: hashes} mapping without stat fingerprints
+            file_stats = {}
+            if isinstance(wbch_files.get("files"), dict) and isinstance(wbch_files.get("stats"), dict):
+                file_stats = wbch_files["stats"]
+                wbch_files = wbch_files["files"]
+
+            for file_path, hashes in wbch_files.items():
+                for hash_name, hash_value in hashes.items():
+                    self.__set_hash(file_path, hash_name, hash_value)
+
+            for file_path, file_stat in file_stats.items():
+                self.__set_file_stat(file_path, FileStat(*file_stat))
+
+        if self.journal_path.exists():
+            self.__replay_journal()
+
+    def __replay_journal(self):
+        torn = False
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last line can be torn by a crash while writing
+                    logger.warn(f"Ignoring incomplete index journal entry in: {self.journal_path}")
+                    torn = True
+                    break
+                self.__apply(entry)
+                self.__journal_length += 1
+        logger.info(f"Replayed {self.__journal_length} index journal entries")
+        if torn:
+            # New entries must not be appended to the torn line
+            self.persist_dict_to_file()
+
+    def __apply(self, entry: List):
+        operation = entry[0]
+        if operation == "hash":
+            self.__set_hash(entry[1], entry[2], entry[3])
+        elif operation == "stat":
+            self.__set_file_stat(entry[1], FileStat(*entry[2]))
+        elif operation == "remove":
+            self.__remove_file(entry[1])
+        elif operation == "move":
+            self.__move_file(entry[1], entry[2])
+        elif operation == "clear":
+            self.__clear_hash_type(entry[1])
+        else:
+            logger.warn(f"Unknown index journal operation: {operation}")
+
+    def __journal(self, entry: List):
+        self.__journal_buffer.append(json.dumps(entry))
+        if len(self.__journal_buffer) >= self.journal_batch_size:
+            self.flush()
 
-        for file_path, hashes in wbch_files.items():
-            single_file_hash_dict = {}
-            for hash_name, hash_value in hashes.items():
-                single_file_hash_dict[hash_name] = hash_value
-            self.__hash_dict[file_path] = single_file_hash_dict
+    def flush(self):
+        if not self.__journal_buffer:
+            return
+        with open(self.journal_path, "a") as f:
+            f.write("\n".join(self.__journal_buffer) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.__journal_length += len(self.__journal_buffer)
+        self.__journal_buffer = []
+        if self.__journal_length >= self.compaction_threshold:
+            self.persist_dict_to_file()
 
     def persist_dict_to_file(self):
-        wbch_str = json.dumps(self.__hash_dict, indent=2)
-        with open(self.json_path, "w") as f:
+        # Write a new snapshot next to the old one and swap it in, a crash never leaves a half written index
+        wbch_str = json.dumps({"files": self.get_dict(), "stats": self.__stat_dict}, indent=2)
+        tmp_path = self.json_path.with_name(self.json_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
             f.write(wbch_str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.json_path)
+        # Replaying the journal on top of the new snapshot is harmless, so it is only dropped afterwards
+        self.journal_path.unlink(missing_ok=True)
+        self.__journal_buffer = []
+        self.__journal_length = 0
         logger.info("Index persisted")
 
     def get_file_names_in_dict(self) -> List[str]:
-        return list(self.__hash_dict.keys())
+        file_names = {}
+        for type_dict in self.__hash_dict.values():
+            file_names.update(dict.fromkeys(type_dict))
+        return list(file_names)
 
-    def file_has_hash(self, file_path: str | Path, hash_type: str) -> bool:
+    def __get_indexed_files(self) -> List[str]:
+        # Files with hashes or a stat fingerprint
+        return list(dict.fromkeys(self.get_file_names_in_dict() + list(self.__stat_dict.keys())))
+
+    def __has_hashes(self, file_path: str) -> bool:
+        return any(file_path in type_dict for type_dict in self.__hash_dict.values())
+
+    def get_files_in_directory(self, directory: str | Path) -> List[str]:
+        prefix = os.path.join(str(directory), "")
+        return [file_path for file_path in self.__get_indexed_files() if file_path.startswith(prefix)]
+
+    def has_file(self, file_path: str | Path) -> bool:
         file_path = str(file_path)
-        if file_path in self.__hash_dict:
-            return hash_type in self.__hash_dict[file_path]
-        return False
+        return file_path in self.__stat_dict or self.__has_hashes(file_path)
+
+    def file_has_hash(self, file_path: str | Path, hash_type: str) -> bool:
+        return str(file_path) in self.__hash_dict.get(hash_type, {})
 
     def get_hash(self, file_path: str | Path, hash_type: str) -> Optional[str]:
-        file_path = str(file_path)
-        if file_path in self.__hash_dict:
-            return self.__hash_dict[file_path][hash_type]
-        return None
+        digest = self.__hash_dict.get(hash_type, {}).get(str(file_path))
+        return decode_digest(digest) if digest is not None else None
 
-    def get_hashes(self, file_path: str | Path) -> Dict[str, str]:
+    def get_hashes(self, file_path: str | Path) -> HashMap:
         file_path = str(file_path)
-        if file_path in self.__hash_dict:
-            return self.__hash_dict[file_path]
-        return {}
+        hashes = HashMap()
+        for hash_type, type_dict in self.__hash_dict.items():
+            if file_path in type_dict:
+                hashes.set_digest(hash_type, type_dict[file_path])
+        return hashes
 
     def clear_hash_type(self, hash_type: str):
-        for file_path, hash_dict in self.__hash_dict.items():
-            if hash_type in hash_dict:
-                del hash_dict[hash_type]
+        self.__clear_hash_type(hash_type)
+        self.__journal(["clear", hash_type])
+
+    def __clear_hash_type(self, hash_type: str):
+        for digest in self.__hash_dict.pop(hash_type, {}).values():
+            self.__changed(hash_type, digest)
+        self.__reverse_index.pop(hash_type, None)
+
+    def __get_reverse_index(self, hash_type: str) -> Dict[Digest, str | Set[str]]:
+        if hash_type not in self.__reverse_index:
+            self.__reverse_index[hash_type] = {}
+            for file_path, digest in self.__hash_dict.get(hash_type, {}).items():
+                self.__index_file(hash_type, digest, file_path)
+        return self.__reverse_index[hash_type]
+
+    def __index_file(self, hash_type: str, digest: Digest, file_path: str):
+        reverse_index = self.__reverse_index[hash_type]
+        indexed = reverse_index.get(digest)
+        if indexed is None:
+            reverse_index[digest] = file_path
+        elif isinstance(indexed, set):
+            indexed.add(file_path)
+        elif indexed != file_path:
+            reverse_index[digest] = {indexed, file_path}
+
+    def __unindex_file(self, hash_type: str, digest: Digest, file_path: str):
+        reverse_index = self.__reverse_index[hash_type]
+        indexed = reverse_index.get(digest)
+        if indexed == file_path:
+            del reverse_index[digest]
+        elif isinstance(indexed, set):
+            indexed.discard(file_path)
+            if len(indexed) == 1:
+                reverse_index[digest] = indexed.pop()
+
+    def find_files_by_hash(self, hash_value: str, hash_type: str) -> List[Path]:
+        indexed = self.__get_reverse_index(hash_type).get(encode_digest(hash_value))
+        if indexed is None:
+            return []
+        if isinstance(indexed, str):
+            return [Path(indexed)]
+        return [Path(file_path) for file_path in sorted(indexed)]
 
     def find_file_by_hash(self, hash_value: str, hash_type: Optional[str] = None) -> Optional[Path]:
-        for file_path, hash_dict in self.__hash_dict.items():
-            if hash_type:
-                if hash_type in hash_dict and hash_dict[hash_type] == hash_value:
-                    return Path(file_path)
-            else:
-                for hash_name, hash_val in hash_dict.items():
-                    if hash_val == hash_value:
-                        return Path(file_path)
+        for search_type in [hash_type] if hash_type else list(self.__hash_dict):
+            file_paths = self.find_files_by_hash(hash_value, search_type)
+            if file_paths:
+                return file_paths[0]
         return None
 
+    def get_duplicates(self, hash_type: str = "hash") -> Dict[str, List[str]]:
+        # Groups of files sharing a hash value, by hex value
+        return {decode_digest(digest): sorted(indexed)
+                for digest, indexed in self.__get_reverse_index(hash_type).items() if isinstance(indexed, set)}
+
     def set_hash(self, file_path: str | Path, hash_type: str, hash_value: str):
         file_path = str(file_path)
-        if file_path not in self.__hash_dict:
-            self.__hash_dict[file_path] = {}
-        self.__hash_dict[file_path][hash_type] = hash_value
+        self.__set_hash(file_path, hash_type, hash_value)
+        self.__journal(["hash", file_path, hash_type, hash_value])
+
+    def __set_hash(self, file_path: str, hash_type: str, hash_value: str):
+        self.__set_digest(file_path, hash_type, encode_digest(hash_value))
+
+    def __set_digest(self, file_path: str, hash_type: str, digest: Digest):
+        if hash_type not in self.__hash_dict:
+            self.__hash_dict[sys.intern(hash_type)] = {}
+        old_digest = self.__hash_dict[hash_type].get(file_path)
+        if old_digest == digest:
+            return
+        self.__hash_dict[hash_type][file_path] = digest
+        if hash_type in self.__reverse_index:
+            if old_digest is not None:
+                self.__unindex_file(hash_type, old_digest, file_path)
+            self.__index_file(hash_type, digest, file_path)
+        if old_digest is not None:
+            self.__changed(hash_type, old_digest)
+        self.__changed(hash_type, digest)
 
     def get_dict(self) -> Dict[str, Dict[str, str]]:
-        return self.__hash_dict.copy()
+        hash_dict: Dict[str, Dict[str, str]] = {}
+        for hash_type, type_dict in self.__hash_dict.items():
+            for file_path, digest in type_dict.items():
+                hash_dict.setdefault(file_path, {})[hash_type] = decode_digest(digest)
+        return hash_dict
 
     def get_hash_type_dict(self, hash_type: str) -> Dict[str, str]:
-        hash_type_dict = {}
-        for file_path, hash_dict in self.__hash_dict.items():
-            if hash_type in hash_dict:
-                hash_type_dict[file_path] = hash_dict[hash_type]
-        return hash_type_dict
-
-    def clean_removed_files(self):
-        for file_path in list(self.__hash_dict.keys()):
-            if not os.path.exists(file_path):
+        return {file_path: decode_digest(digest) for file_path, digest in self.__hash_dict.get(hash_type, {}).items()}
+
+    def get_file_stat(self, file_path: str | Path) -> Optional[FileStat]:
+        return self.__stat_dict.get(str(file_path))
+
+    def set_file_stat(self, file_path: str | Path, file_stat: FileStat):
+        file_path = str(file_path)
+        self.__set_file_stat(file_path, file_stat)
+        self.__journal(["stat", file_path, list(file_stat)])
+
+    def __set_file_stat(self, file_path: str, file_stat: FileStat):
+        old_stat = self.__stat_dict.get(file_path)
+        if old_stat is not None and self.__stat_index.get(old_stat) == file_path:
+            del self.__stat_index[old_stat]
+        self.__stat_dict[file_path] = file_stat
+        self.__stat_index[file_stat] = file_path
+
+    def find_file_by_stat(self, file_stat: FileStat) -> Optional[Path]:
+        file_path = self.__stat_index.get(file_stat)
+        if file_path is None:
+            return None
+        return Path(file_path)
+
+    def remove_file(self, file_path: str | Path):
+        file_path = str(file_path)
+        self.__remove_file(file_path)
+        self.__journal(["remove", file_path])
+
+    def __remove_file(self, file_path: str):
+        for hash_type, type_dict in self.__hash_dict.items():
+            digest = type_dict.pop(file_path, None)
+            if digest is None:
+                continue
+            if hash_type in self.__reverse_index:
+                self.__unindex_file(hash_type, digest, file_path)
+            self.__changed(hash_type, digest)
+        file_stat = self.__stat_dict.pop(file_path, None)
+        if file_stat is not None and self.__stat_index.get(file_stat) == file_path:
+            del self.__stat_index[file_stat]
+
+    def move_file(self, old_path: str | Path, new_path: str | Path):
+        old_path = str(old_path)
+        new_path = str(new_path)
+        if old_path == new_path:
+            return
+        self.__move_file(old_path, new_path)
+        self.__journal(["move", old_path, new_path])
+
+    def __move_file(self, old_path: str, new_path: str):
+        if not self.__has_hashes(old_path) and old_path not in self.__stat_dict:
+            # Already moved, happens when a journal is replayed onto a newer snapshot
+            return
+        hashes = {hash_type: type_dict[old_path] for hash_type, type_dict in self.__hash_dict.items()
+                  if old_path in type_dict}
+        file_stat = self.__stat_dict.get(old_path)
+        self.__remove_file(old_path)
+        self.__remove_file(new_path)
+        for hash_type, digest in hashes.items():
+            self.__set_digest(new_path, hash_type, digest)
+        if file_stat is not None:
+            self.__set_file_stat(new_path, file_stat)
+
+    def sync_file_stat(self, file_path: str | Path, file_stat: FileStat):
+        file_path = str(file_path)
+        old_stat = self.__stat_dict.get(file_path)
+        if old_stat == file_stat:
+            return
+
+        if old_stat is None and self.__has_hashes(file_path):
+            # Entry from an index without fingerprints, trust the recorded hashes
+            self.set_file_stat(file_path, file_stat)
+            return
+        if old_stat is not None:
+            logger.info(f"File changed: {file_path}, dropping its hashes")
+            self.remove_file(file_path)
+
+        old_path = self.__stat_index.get(file_stat)
+        if old_path is not None and old_path != file_path and not os.path.exists(old_path):
+            logger.info(f"File moved: {old_path} -> {file_path}, keeping its hashes")
+            self.move_file(old_path, file_path)
+            return
+
+        self.set_file_stat(file_path, file_stat)
+
+    def clean_removed_files(self, found_files: Optional[Iterable[str | Path]] = None):
+        # Files a walk just found exist, only the rest of the index has to be checked on disk
+        found_files = {str(Path(file_path)) for file_path in found_files} if found_files is not None else set()
+        for file_path in self.__get_indexed_files():
+            if file_path not in found_files and not os.path.exists(file_path):
                 logger.info(f"Removing file: {file_path} from index")
-                del self.__hash_dict[file_path]
+                self.remove_file(file_path)
+
+
+HashFunction = Callable[[Path, Set[str]], Tuple[Path, Dict[str, str]]]
+
+
+class HashProgress(NamedTuple):
+    done: int
+    total: int
+    elapsed: float
+    eta: Optional[float]
+
+
+def log_progress(progress: HashProgress):
+    eta = f", about {progress.eta:.0f}s left" if progress.eta is not None else ""
+    logger.info(f"Hashed {progress.done}/{progress.total} files in {progress.elapsed:.0f}s{eta}")
 
 
 class Hasher:
-    hash_function: Callable[[Path], Tuple[Path, Optional[str]]]
-    hash_name: str
+    hash_function: HashFunction
+    hash_names: Set[str]
     hash_dict: HashDict
-    file_names: List[Path]
-    num_workers: int
+    # Hash types that are only computed for some of the files, by hash name
+    limited_hash_names: Dict[str, Set[Path]]
+    # Files found that need hashing, only counted so a library streams through without being held in memory
+    file_count: int
+    # Hash types still missing per file, from when it is found until its hashes are stored
+    missing_hash_names: Dict[Path, Set[str]]
+    io_bound: bool
+    max_in_flight: int
+    batch_size: int
+    checkpoint_files: int
+    checkpoint_seconds: float
+    progress_callback: Callable[[HashProgress], None]
+    __file_iterator: Optional[Iterator[str | Path | os.DirEntry]]
+    __done: int
+    __start_time: float
+    __last_checkpoint: Tuple[int, float]
 
-    def __init__(self, hash_function: Callable[[Path], Tuple[Path, Optional[str]]], hash_name: str, hash_dict: HashDict,
-                 file_names: List[str | Path], num_workers: int = 4):
+    def __init__(self, hash_function: HashFunction, hash_names: Set[str], hash_dict: HashDict,
+                 file_names: Iterable[str | Path | os.DirEntry], max_in_flight: Optional[int] = None,
+                 checkpoint_files: int = 100, checkpoint_seconds: float = 60,
+                 progress_callback: Callable[[HashProgress], None] = log_progress, io_bound: bool = True,
+                 batch_size: int = 1, limited_hash_names: Optional[Dict[str, Iterable[Path]]] = None):
         self.hash_function = hash_function
-        self.hash_name = hash_name
+        self.hash_names = set(hash_names)
         self.hash_dict = hash_dict
-        self.file_names = []
-        self.num_workers = num_workers
-        for file_name in file_names:
-            if not isinstance(file_name, Path):
-                file_name = Path(file_name)
-            if not os.path.exists(file_name):
+        self.limited_hash_names = {hash_name: set(file_names)
+                                   for hash_name, file_names in (limited_hash_names or {}).items()}
+        self.file_count = 0
+        self.missing_hash_names = {}
+        # Disk bound hashers are limited per device by the HashScheduler, cpu bound ones by the core count
+        self.io_bound = io_bound
+        # Files sent to a worker as one task by the HashScheduler, worth it for hashes that take milliseconds
+        self.batch_size = batch_size
+        # Only a few batches are queued at once, results are consumed as they arrive
+        self.max_in_flight = max_in_flight or 8 * batch_size
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_seconds = checkpoint_seconds
+        self.progress_callback = progress_callback
+        # Files are only stated and checked once they are needed, so hashing starts while a walk still runs
+        self.__file_iterator = iter(file_names)
+
+    def next_file(self) -> Optional[Path]:
+        while self.__file_iterator is not None:
+            file_name = next(self.__file_iterator, None)
+            if file_name is None:
+                self.__file_iterator = None
+                break
+            try:
+                if isinstance(file_name, os.DirEntry):
+                    file_stat = FileStat.from_dir_entry(file_name)
+                    file_name = Path(file_name.path)
+                else:
+                    file_name = Path(file_name)
+                    file_stat = FileStat.from_path(file_name)
+            except OSError:
                 logger.warn(f"File not found: {file_name}")
                 continue
-            if self.hash_dict.file_has_hash(file_name, hash_name):
+            self.hash_dict.sync_file_stat(file_name, file_stat)
+            missing_hash_names = {hash_name for hash_name in self.hash_names
+                                  if file_name in self.limited_hash_names.get(hash_name, (file_name,))
+                                  and not self.hash_dict.file_has_hash(file_name, hash_name)}
+            if not missing_hash_names:
                 continue
-            self.file_names.append(file_name)
+            self.file_count += 1
+            self.missing_hash_names[file_name] = missing_hash_names
+            return file_name
+        return None
 
-    def hash_files(self):
-        if len(self.file_names) == 0:
-            logger.info(f"No files to hash with hasher: {self.hash_name}")
-            return
-        if self.num_workers > 1:
-            self.__hash_files_parallel()
-        else:
-            self.__hash_files_serial()
-
-    def __hash_files_parallel(self):
-        logger.info(f"Hashing {len(self.file_names)} files with {self.num_workers} workers")
-        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
-            futures: List[Future] = []
-            for file_path in self.file_names:
-                futures.append(executor.submit(self.hash_function, file_path))
-
-            for future in as_completed(futures):
-                file_path, file_hash = future.result()
-                if file_hash:
-                    self.hash_dict.set_hash(file_path, self.hash_name, file_hash)
-                    logger.debug(f"Hash: {file_hash} belongs to file: {file_path}")
-
-    def __hash_files_serial(self):
-        logger.info(f"Hashing {len(self.file_names)} files serially")
-        for file_path in self.file_names:
-            _, file_hash = self.hash_function(file_path)
-            if file_hash:
-                self.hash_dict.set_hash(file_path, self.hash_name, file_hash)
-                logger.debug(f"Hash: {file_hash} belongs to file: {file_path}")
-
-
-def phash_file(file_path: Path, work_dir: Optional[Path] = None) -> Tuple[Path, Optional[str]]:
+    def all_files_found(self) -> bool:
+        return self.__file_iterator is None
+
+    def begin(self):
+        self.__done = 0
+        self.__start_time = time.monotonic()
+        self.__last_checkpoint = (0, self.__start_time)
+
+    def end(self):
+        if self.__done > self.__last_checkpoint[0]:
+            self.__checkpoint()
+
+    def store_hashes(self, file_path: Path, file_hashes: Dict[str, str]):
+        self.missing_hash_names.pop(file_path, None)
+        for hash_name, file_hash in file_hashes.items():
+            self.hash_dict.set_hash(file_path, hash_name, file_hash)
+            logger.debug(f"{hash_name}: {file_hash} belongs to file: {file_path}")
+
+        self.__done += 1
+        files_since_checkpoint = self.__done - self.__last_checkpoint[0]
+        if files_since_checkpoint >= self.checkpoint_files or \
+                time.monotonic() - self.__last_checkpoint[1] >= self.checkpoint_seconds:
+            self.__checkpoint()
+
+    def __checkpoint(self):
+        self.hash_dict.flush()
+        now = time.monotonic()
+        self.__last_checkpoint = (self.__done, now)
+
+        elapsed = now - self.__start_time
+        total = self.file_count
+        # The total is only known once all files have been found
+        eta = elapsed / self.__done * (total - self.__done) if self.__done and self.all_files_found() else None
+        if self.progress_callback:
+            self.progress_callback(HashProgress(self.__done, total, elapsed, eta))
+
+
+def phash_file(file_path: Path, hash_names: Set[str] = frozenset({"phash"})) -> Tuple[Path, Dict[str, str]]:
+    from video_phash import video_phash
+    try:
+        return file_path, {"phash": video_phash(file_path, frame_interval=0.5)}
+    except Exception as e:
+        logger.error(f"Error hashing file: {file_path}, Error: {e}")
+        return file_path, {}
+
+
+def sparse_phash_file(file_path: Path, hash_names: Set[str] = frozenset({"sphash"})) -> Tuple[Path, Dict[str, str]]:
+    from video_phash import sparse_video_phash
+    try:
+        return file_path, {"sphash": sparse_video_phash(file_path)}
+    except Exception as e:
+        logger.error(f"Error hashing file: {file_path}, Error: {e}")
+        return file_path, {}
+
+
+def phash_file_videohash2(file_path: Path, hash_names: Set[str] = frozenset({"phash"}),
+                          work_dir: Optional[Path] = None) -> Tuple[Path, Dict[str, str]]:
+    # Reference implementation, extracts the frames into a storage directory on disk
     from videohash2 import VideoHash, VideoHashError
     work_dir = str(work_dir) if work_dir else None
     try:
         video_hash = VideoHash(path=str(file_path), storage_path=work_dir, frame_interval=0.5, do_not_copy=True)
         phash = video_hash.hash_hex
         video_hash.delete_storage_path()
-        return file_path, phash
+        return file_path, {"phash": phash}
     except VideoHashError as e:
         logger.error(f"Error hashing file: {file_path}, Error: {e}")
-        return file_path, None
+        return file_path, {}
+
+
+def select_full_hash_candidates(hash_dict: HashDict, file_names: Iterable[str | Path],
+                                db: Optional[EpisodeDb]) -> List[Path]:
+    # A quick hash only rules a file out against db versions that have one. A version with a sha256 but
+    # no quick hash could be any file, so then every file is read completely.
+    file_names = [Path(file_name) for file_name in file_names]
+    if db is None or db.count_versions("hash", "qhash") < db.count_versions("hash"):
+        return file_names
+    known_quick_hashes = db.get_hash_values("qhash")
+    if not known_quick_hashes:
+        # Without quick hashes in the db nothing can be ruled out
+        return file_names
+
+    local_quick_hashes = Counter(hash_dict.get_hash_type_dict("qhash").values())
+    candidates = []
+    for file_name in file_names:
+        quick_hash = hash_dict.get_hash(file_name, "qhash")
+        if quick_hash is None or quick_hash in known_quick_hashes or local_quick_hashes[quick_hash] > 1:
+            candidates.append(file_name)
+    logger.info(f"{len(candidates)} of {len(file_names)} files need a full hash")
+    return candidates
 
 
-def hash_file(file_path: Path) -> Tuple[Path, Optional[str]]:
+QUICK_HASH_SAMPLE_SIZE = 64 * 1024
+
+
+def quick_hash_file(file_path: Path, hash_names: Set[str] = frozenset({"qhash"})) -> Tuple[Path, Dict[str, str]]:
+    # sha256 over the little endian file size followed by samples from the head, middle and tail of the file.
+    # Files too small for three samples are hashed completely.
     import hashlib
     try:
-        sha256_hash = hashlib.sha256()
+        quick_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(1 * 10 ** 6), b""):
-                sha256_hash.update(chunk)
-        return file_path, sha256_hash.hexdigest()
+            file_size = os.fstat(f.fileno()).st_size
+            quick_hash.update(file_size.to_bytes(8, "little"))
+            if file_size <= 3 * QUICK_HASH_SAMPLE_SIZE:
+                quick_hash.update(f.read())
+            else:
+                for offset in (0, (file_size - QUICK_HASH_SAMPLE_SIZE) // 2, file_size - QUICK_HASH_SAMPLE_SIZE):
+                    f.seek(offset)
+                    quick_hash.update(f.read(QUICK_HASH_SAMPLE_SIZE))
+        return file_path, {"qhash": quick_hash.hexdigest()}
+    except Exception as e:
+        logger.error(f"Error hashing file: {file_path}, Error: {e}")
+        return file_path, {}
+
+
+READERS = ("read", "readinto", "mmap")
+DEFAULT_READER = "readinto"
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+def advise_sequential(fd: int):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+
+
+def read_blocks(f: BinaryIO, block_size: int = DEFAULT_BLOCK_SIZE,
+                reader: str = DEFAULT_READER) -> Iterator[bytes | memoryview]:
+    # The readinto and mmap readers yield views that are only valid until the next block is read
+    if reader == "read":
+        yield from iter(lambda: f.read(block_size), b"")
+        return
+
+    advise_sequential(f.fileno())
+    if reader == "readinto":
+        buffer = bytearray(block_size)
+        with memoryview(buffer) as view:
+            while read_size := f.readinto(buffer):
+                yield view[:read_size]
+    elif reader == "mmap":
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                for offset in range(0, file_size, block_size):
+                    # Released right away, the mmap can't be closed while a block is still exported
+                    with view[offset:offset + block_size] as block:
+                        yield block
+    else:
+        raise ValueError(f"Unknown reader: {reader}")
+
+
+# Byte level hash types that hash_file computes in a single read, "hash" is the sha256 used by the epdb
+BYTE_HASH_NAMES = ("hash", "md5", "sha1", "blake2b", "xxh3", "blake3")
+
+
+def new_digest(hash_name: str):
+    import hashlib
+    if hash_name == "hash":
+        return hashlib.sha256()
+    if hash_name == "xxh3":
+        import xxhash
+        return xxhash.xxh3_64()
+    if hash_name == "blake3":
+        from blake3 import blake3
+        return blake3()
+    if hash_name not in BYTE_HASH_NAMES:
+        raise ValueError(f"Unknown hash type: {hash_name}")
+    return hashlib.new(hash_name)
+
+
+def available_hash_names(hash_names: Iterable[str]) -> List[str]:
+    # xxh3 and blake3 need optional packages, hash types without their package are dropped once at startup
+    available = []
+    for hash_name in hash_names:
+        try:
+            new_digest(hash_name)
+        except ImportError as e:
+            logger.warn(f"Skipping hash type {hash_name}, its package is not installed: {e}")
+            continue
+        available.append(hash_name)
+    return available
+
+
+def hash_file(file_path: Path, hash_names: Set[str] = frozenset({"hash"}), block_size: int = DEFAULT_BLOCK_SIZE,
+              reader: str = DEFAULT_READER) -> Tuple[Path, Dict[str, str]]:
+    # A hash type that can't be created is skipped on its own, it never costs the file its other hashes
+    digests = {}
+    for hash_name in hash_names:
+        try:
+            digests[hash_name] = new_digest(hash_name)
+        except ImportError as e:
+            logger.error(f"Can't compute {hash_name} for file: {file_path}, Error: {e}")
+    try:
+        with open(file_path, "rb", buffering=0) as f:
+            for chunk in read_blocks(f, block_size, reader):
+                for digest in digests.values():
+                    digest.update(chunk)
+        return file_path, {hash_name: digest.hexdigest() for hash_name, digest in digests.items()}
     except Exception as e:
         logger.error(f"Error hashing file: {file_path}, Error: {e}")
-        return file_path, None
+        return file_path, {}
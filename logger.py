@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 from colorama import Fore, Style, init
 from datetime import datetime
@@ -27,13 +28,21 @@ logger = logging.getLogger("custom_logger")
 logger.setLevel(logging.DEBUG)
 
 # Create console handler
-console_handler = logging.StreamHandler(sys.stdout)
+# Spawned workers import this module again, the environment tells them where the main process logs to
+LOG_STREAM_VARIABLE = "WBCH_LOG_STREAM"
+console_handler = logging.StreamHandler(sys.stderr if os.environ.get(LOG_STREAM_VARIABLE) == "stderr" else sys.stdout)
 console_handler.setLevel(logging.DEBUG)
 console_handler.setFormatter(CustomFormatter())
 
 # Add handler to logger
 logger.addHandler(console_handler)
 
+
+def log_to_stderr():
+    # Keeps stdout free for output that is piped into other programs
+    os.environ[LOG_STREAM_VARIABLE] = "stderr"
+    console_handler.setStream(sys.stderr)
+
 # Example usage
 if __name__ == "__main__":
     logger.debug("This is a debug message")
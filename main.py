@@ -1,55 +1,213 @@
+import os
 import sys
+import time
 import signal
 import argparse
+import functools
+import threading
 import multiprocessing
 from pathlib import Path
-from typing import Optional, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, List, Dict, Iterable, Callable
 
-from file_management import find_files
-from hasher import Hasher, HashDict, hash_file, phash_file
-from logger import logger
-from epdb import download_epdb, load_db, report
+from file_management import FileStream, DEFAULT_EXCLUDE_PATTERNS
+from hasher import Hasher, HashDict, hash_file, phash_file, sparse_phash_file, quick_hash_file, \
+    select_full_hash_candidates, available_hash_names, READERS, DEFAULT_READER, DEFAULT_BLOCK_SIZE, BYTE_HASH_NAMES, \
+    HashFunction
+from logger import logger, log_to_stderr
+from model.episode_db import EpisodeDb
+from scheduler import HashScheduler
+from epdb import update_and_load_db, report, report_phash_matches, ReportCache
+from report_writer import REPORT_FORMATS, write_report_records, default_report_output
+from watcher import Watcher, create_watcher
+from renamer import RENAME_JOURNAL_NAME, plan_renames, apply_plan, undo_renames, print_plan, confirm_plan
 
 # Fix multiprocessing issues in PyInstaller
 multiprocessing.set_start_method("spawn", force=True)
 
 hash_dict: Optional[HashDict] = None
 
-def main(base_path: str | Path):
+def main(base_path: str | Path, block_size: int = DEFAULT_BLOCK_SIZE, reader: str = DEFAULT_READER,
+         extra_hashes: Optional[List[str]] = None, phash_matches: bool = False, phash_distance: int = 8,
+         fuzzy: bool = True, io_workers: Optional[int] = None, cpu_workers: Optional[int] = None,
+         sparse_phash: bool = False, exclude_patterns: Optional[List[str]] = None, follow_symlinks: bool = False,
+         watch: bool = False, poll_interval: float = 60, polling: bool = False, epdb_path: str | Path = "epdb.json",
+         rename: bool = False, dry_run: bool = False, undo_rename: bool = False, assume_yes: bool = False,
+         rename_workers: int = 8, update_db: bool = False, summary: bool = False, report_format: str = "text",
+         report_output: Optional[str] = None):
     global hash_dict
     if not isinstance(base_path, Path):
         base_path = Path(base_path)
 
-    print("Run this Program in a terminal with emojie support")
+    # Report records streamed to stdout are meant for jq or a csv reader, everything else goes to stderr
+    streaming_records = report_format != "text" and report_output == "-"
+    if streaming_records:
+        log_to_stderr()
+    console = sys.stderr if streaming_records else sys.stdout
+    print("Run this Program in a terminal with emojie support", file=console)
+    extra_hashes = available_hash_names(extra_hashes or [])
 
-    # epdb_path = download_epdb(base_path)
-    db = load_db("epdb.json")
-    files: List[Path] = find_files(base_path)
     hash_dict = HashDict(base_path/"wbch_index.json")
+    if undo_rename:
+        hash_dict.load_dict_from_file()
+        undone = undo_renames(base_path/RENAME_JOURNAL_NAME, hash_dict, rename_workers)
+        hash_dict.flush()
+        print(f"Undid {undone} renames", file=console)
+        return
+
+    # The walk starts right away and runs while the index is parsed and the quick hashes are computed,
+    # later stages replay the files it found
+    files = FileStream(base_path, (*DEFAULT_EXCLUDE_PATTERNS, *(exclude_patterns or [])), follow_symlinks)
+    files.start()
+    # The db is downloaded and loaded at the same time
+    db_loader = ThreadPoolExecutor(max_workers=1)
+    db_future = db_loader.submit(update_and_load_db, epdb_path, update_db)
+    db_loader.shutdown(wait=False)
     hash_dict.load_dict_from_file()
 
     # hash_dict.clear_hash_type("phash")
-    hash_dict.clean_removed_files()
 
-    hash_types = {
-        "hash": hash_file,
-        "phash": phash_file
-    }
-    for hash_type, hash_func in hash_types.items():
-        hasher = Hasher(hash_func, hash_type, hash_dict, files, num_workers=4)
-        hasher.hash_files()
-    hash_dict.persist_dict_to_file()
+    scheduler = HashScheduler(readers_per_device=io_workers, cpu_workers=cpu_workers)
+    byte_hash_func = functools.partial(hash_file, block_size=block_size, reader=reader)
+    hash_collection(db_future, hash_dict, scheduler, files, byte_hash_func, extra_hashes, sparse_phash)
+    db = db_future.result()
+    # Runs after the hashers have matched moved files by their stat fingerprint
+    hash_dict.clean_removed_files(files)
+    # Only the changes of this run are appended, the snapshot is rewritten once the journal is long enough
+    hash_dict.flush()
+
+    # Reports in watch mode only process the seasons whose files changed since the last one
+    report_cache = ReportCache(db, hash_dict) if db else None
+    report_func = functools.partial(report_collection, db, hash_dict, base_path, report_cache,
+                                    phash_distance if fuzzy else None, summary, report_format, report_output)
+    report_func()
+    if phash_matches:
+        report_phash_matches(db, hash_dict, base_path, phash_distance, console)
 
-    report(db, hash_dict, base_path)
+    if rename or dry_run:
+        plan = plan_renames(db, hash_dict)
+        print_plan(plan, base_path, console)
+        if not dry_run and plan.rename_count() and (assume_yes or confirm_plan(plan, console)):
+            renamed = apply_plan(plan, hash_dict, base_path/RENAME_JOURNAL_NAME, rename_workers)
+            hash_dict.flush()
+            print(f"Renamed {renamed} files, undo with --undo_rename", file=console)
+
+    if watch:
+        watcher = create_watcher(base_path, (*DEFAULT_EXCLUDE_PATTERNS, *(exclude_patterns or [])), follow_symlinks,
+                                 poll_interval, polling)
+        watch_collection(db, hash_dict, scheduler, watcher, byte_hash_func, extra_hashes, sparse_phash, report_func)
+    scheduler.close()
 
     if hasattr(sys, '_MEIPASS') or ".exe" in sys.argv[0]:
-        input("Press Enter to exit...")
+        print("Press Enter to exit...", end="", file=console, flush=True)
+        input()
+
+
+def report_collection(db: EpisodeDb, hash_dict: HashDict, base_path: Path, report_cache: ReportCache,
+                      fuzzy_distance: Optional[int], summary: bool, report_format: str, report_output: Optional[str]):
+    # Records streamed to stdout replace the text report, anywhere else they are written next to it
+    if report_format == "text" or report_output != "-":
+        report(db, hash_dict, base_path, fuzzy_distance=fuzzy_distance, summary=summary, cache=report_cache)
+    if report_format == "text":
+        return
+    report_output = report_output or str(default_report_output(base_path, report_format))
+    count = write_report_records(db, hash_dict, base_path, report_format, report_output,
+                                 report_cache.get_fuzzy_matches(base_path, fuzzy_distance))
+    if report_output != "-":
+        logger.info(f"Wrote {count} report records to {report_output}")
+
+
+def hash_collection(db: Optional[EpisodeDb] | Future, hash_dict: HashDict, scheduler: HashScheduler,
+                    files: Iterable[str | Path | os.DirEntry], byte_hash_func: HashFunction,
+                    extra_hashes: Optional[List[str]] = None, sparse_phash: bool = False):
+    # A quick hash reads a few blocks, batches save most of the round trips to the workers
+    scheduler.run([Hasher(quick_hash_file, {"qhash"}, hash_dict, files, batch_size=16)])
+    if isinstance(db, Future):
+        # Quick hashes don't need the db, it is only waited for once they are done
+        db = db.result()
+
+    # Only files the quick hash can't rule out get a sha256, the extra hashes are computed for every file
+    full_hash_files = select_full_hash_candidates(hash_dict, files, db)
+    # All byte level hashes are computed from a single read of each file,
+    # the disk bound byte hashes and the cpu bound phash run side by side
+    hashers = [
+        Hasher(byte_hash_func, {"hash", *(extra_hashes or [])}, hash_dict, files,
+               limited_hash_names={"hash": full_hash_files}),
+        Hasher(phash_file, {"phash"}, hash_dict, files, io_bound=False)
+    ]
+    if sparse_phash:
+        # Stored as its own hash type, the keyframe collage is not comparable with the epdb phash
+        hashers.append(Hasher(sparse_phash_file, {"sphash"}, hash_dict, files, io_bound=False))
+    scheduler.run(hashers)
+
+
+def watch_collection(db: Optional[EpisodeDb], hash_dict: HashDict, scheduler: HashScheduler, watcher: Watcher,
+                     byte_hash_func: HashFunction, extra_hashes: Optional[List[str]], sparse_phash: bool,
+                     report_func: Callable[[], None], settle_seconds: float = 5):
+    report_requested = threading.Event()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda sig, frame: report_requested.set())
+    if sys.stdin and sys.stdin.isatty():
+        threading.Thread(target=wait_for_enter, args=(report_requested,), daemon=True).start()
+    logger.info("Watching the collection for changes, press Enter or send SIGUSR1 for a report")
+
+    # Changed files are hashed once they had no new events for settle_seconds, copies in progress are skipped
+    changed_files: Dict[str, float] = {}
+    while True:
+        for event in watcher.events(timeout=1.0):
+            path = str(Path(event.path))
+            if event.kind == "rescan":
+                logger.info("Rescanning the collection")
+                files = FileStream(watcher.base_path, watcher.exclude_patterns, watcher.follow_symlinks)
+                hash_collection(db, hash_dict, scheduler, files, byte_hash_func, extra_hashes, sparse_phash)
+                hash_dict.clean_removed_files(files)
+            elif event.kind == "moved":
+                old_path = str(Path(event.old_path))
+                old_files = hash_dict.get_files_in_directory(old_path) if event.is_dir else [old_path]
+                for old_file in old_files:
+                    if hash_dict.has_file(old_file):
+                        logger.info(f"File moved: {old_file} -> {path + old_file[len(old_path):]}")
+                        hash_dict.move_file(old_file, path + old_file[len(old_path):])
+                if event.is_dir:
+                    for old_file in [file for file in changed_files if file.startswith(old_path + os.sep)]:
+                        changed_files[path + old_file[len(old_path):]] = changed_files.pop(old_file)
+                else:
+                    changed_files.pop(old_path, None)
+                    changed_files[path] = time.monotonic()
+            elif event.kind == "removed":
+                removed_files = hash_dict.get_files_in_directory(path) if event.is_dir else [path]
+                for removed_file in removed_files:
+                    if hash_dict.has_file(removed_file) and not os.path.exists(removed_file):
+                        logger.info(f"Removing file: {removed_file} from index")
+                        hash_dict.remove_file(removed_file)
+                changed_files.pop(path, None)
+            else:
+                changed_files[path] = time.monotonic()
+
+        now = time.monotonic()
+        settled_files = [path for path, last_change in changed_files.items() if now - last_change >= settle_seconds]
+        for path in settled_files:
+            del changed_files[path]
+        settled_files = [path for path in settled_files if os.path.exists(path)]
+        if settled_files:
+            logger.info(f"Hashing {len(settled_files)} changed files")
+            hash_collection(db, hash_dict, scheduler, settled_files, byte_hash_func, extra_hashes, sparse_phash)
+        hash_dict.flush()
+
+        if report_requested.is_set():
+            report_requested.clear()
+            report_func()
+
+
+def wait_for_enter(report_requested: threading.Event):
+    for _ in sys.stdin:
+        report_requested.set()
 
 
 def signal_handler(sig, frame):
     logger.info('Program interrupted, stopping...')
     if hash_dict:
-        hash_dict.persist_dict_to_file()
+        hash_dict.flush()
     sys.exit(0)
 
 
@@ -59,5 +217,53 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="WBCH-Organizer to organize and rename your WBCH collection")
     parser.add_argument("-p", "--base_path", type=str, default="./", help="Path to your WBCH collection")
+    parser.add_argument("--epdb", type=str, default="epdb.json",
+                        help="epdb to compare against, json or compiled with compiled_epdb.py")
+    parser.add_argument("--block_size", type=int, default=DEFAULT_BLOCK_SIZE // 1024,
+                        help="Read block size in KiB used for hashing")
+    parser.add_argument("--reader", type=str, choices=READERS, default=DEFAULT_READER,
+                        help="How files are read for hashing")
+    parser.add_argument("--extra_hashes", type=str, nargs="*", choices=BYTE_HASH_NAMES[1:], default=[],
+                        help="Additional byte level hashes to compute alongside the sha256")
+    parser.add_argument("--phash_matches", action="store_true",
+                        help="Report the closest epdb version of every file by phash, finds re-encoded or trimmed copies")
+    parser.add_argument("--phash_distance", type=int, default=8,
+                        help="Maximum phash distance for two videos to count as the same")
+    parser.add_argument("--exact_only", action="store_true",
+                        help="Only count files whose sha256 matches, no fuzzy matching by phash")
+    parser.add_argument("--io_workers", type=int,
+                        help="Concurrent readers per disk, detected per device by default (1 for HDDs)")
+    parser.add_argument("--cpu_workers", type=int, help="Workers for phash, defaults to the number of cores")
+    parser.add_argument("--sparse_phash", action="store_true",
+                        help="Also compute a fast phash from evenly spaced keyframes (sphash), meant for long videos")
+    parser.add_argument("--exclude", type=str, nargs="*", default=[],
+                        help="Glob patterns of files and directories to skip, matched by name or relative path")
+    parser.add_argument("--follow_symlinks", action="store_true", help="Follow symlinked files and directories")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and hash new, moved and changed files as they appear")
+    parser.add_argument("--poll_interval", type=float, default=60,
+                        help="Seconds between scans when watching without inotify")
+    parser.add_argument("--polling", action="store_true", help="Watch by scanning even where inotify is available")
+    parser.add_argument("--summary", action="store_true",
+                        help="Only print the season totals and the final report, no line per version")
+    parser.add_argument("--report_format", type=str, choices=REPORT_FORMATS, default="text",
+                        help="Also write one record per version and a summary record as json lines or csv")
+    parser.add_argument("--report_output", type=str,
+                        help="File for the report records, - for stdout, defaults to wbch_report.<format> "
+                             "in the collection")
+    parser.add_argument("--update_db", action="store_true",
+                        help="Download the epdb to the --epdb path, skipped by the server when it didn't change")
+    parser.add_argument("--rename", action="store_true", help="Rename matched files to their original names")
+    parser.add_argument("--dry_run", action="store_true", help="Only print the rename plan")
+    parser.add_argument("--undo_rename", action="store_true", help="Undo the renames recorded in the rename journal")
+    parser.add_argument("--yes", action="store_true", help="Rename without asking for confirmation")
+    parser.add_argument("--rename_workers", type=int, default=8, help="Parallel renames, helps on network shares")
     args = parser.parse_args()
-    main(args.base_path)
+    main(args.base_path, block_size=args.block_size * 1024, reader=args.reader, extra_hashes=args.extra_hashes,
+         phash_matches=args.phash_matches, phash_distance=args.phash_distance, fuzzy=not args.exact_only,
+         io_workers=args.io_workers, cpu_workers=args.cpu_workers, sparse_phash=args.sparse_phash,
+         exclude_patterns=args.exclude, follow_symlinks=args.follow_symlinks, watch=args.watch,
+         poll_interval=args.poll_interval, polling=args.polling, epdb_path=args.epdb, rename=args.rename,
+         dry_run=args.dry_run, undo_rename=args.undo_rename, assume_yes=args.yes, rename_workers=args.rename_workers,
+         update_db=args.update_db, summary=args.summary, report_format=args.report_format,
+         report_output=args.report_output)
@@ -0,0 +1,83 @@
+import sys
+from typing import Callable, Dict, Iterator, MutableMapping, Tuple, Optional
+
+# Hex digests are kept as bytes and 0x prefixed phashes as ints, values that would not
+# round trip exactly stay strings. Hex strings only exist at the json boundary.
+Digest = bytes | int | str
+
+
+def encode_digest(value: str) -> Digest:
+    if value.startswith("0x"):
+        try:
+            number = int(value, base=16)
+        except ValueError:
+            return value
+        return number if hex(number) == value else value
+    if len(value) % 2 == 0:
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if digest.hex() == value:
+            return digest
+    return value
+
+
+def decode_digest(value: Digest) -> str:
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, int):
+        return hex(value)
+    return value
+
+
+class HashMap(MutableMapping[str, str]):
+    # hash type -> hex value mapping that stores the values as digests
+    __slots__ = ("__digests", "__change_listener")
+    __digests: Dict[str, Digest]
+    # Called after every change, the EpisodeDb that indexed the hashes listens
+    __change_listener: Optional[Callable[[], None]]
+
+    def __init__(self, hashes: Optional[Dict[str, str]] = None):
+        self.__digests = {sys.intern(hash_type): encode_digest(hash_value)
+                          for hash_type, hash_value in (hashes or {}).items()}
+        self.__change_listener = None
+
+    def set_change_listener(self, listener: Optional[Callable[[], None]]):
+        self.__change_listener = listener
+
+    def __getitem__(self, hash_type: str) -> str:
+        return decode_digest(self.__digests[hash_type])
+
+    def __setitem__(self, hash_type: str, hash_value: str):
+        self.__digests[sys.intern(hash_type)] = encode_digest(hash_value)
+        if self.__change_listener is not None:
+            self.__change_listener()
+
+    def __delitem__(self, hash_type: str):
+        del self.__digests[hash_type]
+        if self.__change_listener is not None:
+            self.__change_listener()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__digests)
+
+    def __len__(self) -> int:
+        return len(self.__digests)
+
+    def __contains__(self, hash_type: object) -> bool:
+        return hash_type in self.__digests
+
+    def __repr__(self):
+        return f"HashMap({dict(self)})"
+
+    def get_digest(self, hash_type: str) -> Optional[Digest]:
+        return self.__digests.get(hash_type)
+
+    def set_digest(self, hash_type: str, digest: Digest):
+        self.__digests[sys.intern(hash_type)] = digest
+        if self.__change_listener is not None:
+            self.__change_listener()
+
+    def digest_items(self) -> Iterator[Tuple[str, Digest]]:
+        return iter(self.__digests.items())
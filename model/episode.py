@@ -4,6 +4,7 @@ from model.video import Video, VideoVersion
 
 
 class Episode(Video):
+    __slots__ = ("number",)
     number: str
 
     def __init__(self):
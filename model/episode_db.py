@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Set, Iterable, Callable
 
+from model.digest import Digest, encode_digest, decode_digest
 from model.group import Group
 from model.season import Season
 from model.episode import Episode
@@ -9,12 +10,91 @@ from model.video import Video, VideoVersion
 
 
 class EpisodeDb:
-    seasons: List[Season]
-    other_groups: List[Group]
+    __seasons: Tuple[Season, ...]
+    __other_groups: Tuple[Group, ...]
+    # Lookup indexes. Every indexed season, group, video and version hash map reports its changes,
+    # the indexes are rebuilt on the next lookup after one.
+    __season_index: Dict[int, Season]
+    __hash_index: Dict[str, Dict[Digest, Tuple[Season | Group, Video | Episode, VideoVersion]]]
+    __index_stale: bool
+    __change_listener: Callable[[], None]
 
     def __init__(self):
-        self.seasons = []
-        self.other_groups = []
+        self.__seasons = ()
+        self.__other_groups = ()
+        self.__season_index = {}
+        self.__hash_index = {}
+        self.__index_stale = False
+        self.__change_listener = self.__invalidate_index
+
+    @property
+    def seasons(self) -> Tuple[Season, ...]:
+        return self.__seasons
+
+    @seasons.setter
+    def seasons(self, seasons: Iterable[Season]):
+        self.__seasons = tuple(seasons)
+        self.__index_stale = True
+
+    @property
+    def other_groups(self) -> Tuple[Group, ...]:
+        return self.__other_groups
+
+    @other_groups.setter
+    def other_groups(self, other_groups: Iterable[Group]):
+        self.__other_groups = tuple(other_groups)
+        self.__index_stale = True
+
+    def rebuild_index(self):
+        self.__season_index = {}
+        self.__hash_index = {}
+        self.__index_stale = False
+        for season in self.seasons:
+            season.rebuild_index()
+            self.__index_season(season)
+        for group in self.other_groups:
+            self.__index_group(group)
+
+    def __invalidate_index(self):
+        self.__index_stale = True
+
+    def __check_index(self):
+        if self.__index_stale:
+            self.rebuild_index()
+
+    def __index_season(self, season: Season):
+        season.set_change_listener(self.__change_listener)
+        self.__season_index.setdefault(season.number, season)
+        for video in season.get_videos():
+            self.__index_video(season, video)
+
+    def __index_group(self, group: Group):
+        group.set_change_listener(self.__change_listener)
+        for video in group.videos:
+            self.__index_video(group, video)
+
+    def __index_video(self, container: Season | Group, video: Video | Episode):
+        video.set_change_listener(self.__change_listener)
+        for version in video.versions:
+            version.hashes.set_change_listener(self.__change_listener)
+            for hash_type, digest in version.hashes.digest_items():
+                # The first version with a hash wins, same as a scan in db order
+                self.__hash_index.setdefault(hash_type, {}).setdefault(digest, (container, video, version))
+
+    def add_season(self, season: Season):
+        self.__seasons = (*self.__seasons, season)
+        self.__index_season(season)
+
+    def add_group(self, group: Group):
+        self.__other_groups = (*self.__other_groups, group)
+        self.__index_group(group)
+
+    def add_episode(self, season_number: int, episode: Episode):
+        season = self.get_season(season_number)
+        if not season:
+            raise KeyError(f"Season {season_number} not in db")
+        # The season reports the change, the episode is indexed with the next lookup
+        season.add_episode(episode)
 
     def get_episode(self, season_number: int, episode_number: str) -> Optional[Episode]:
         season = self.get_season(season_number)
@@ -23,23 +103,44 @@ class EpisodeDb:
         return season.get_episode_by_number(episode_number)
 
     def get_season(self, season_number: int) -> Optional[Season]:
-        for season in self.seasons:
-            if season.number == season_number:
-                return season
-        return None
+        self.__check_index()
+        return self.__season_index.get(season_number)
 
     def get_version_by_hash(self, hash_type: str, hash_value: str) -> Optional[Tuple[Season|Group, Video|Episode, VideoVersion]]:
+        if hash_value is None:
+            return None
+        self.__check_index()
+        return self.__hash_index.get(hash_type, {}).get(encode_digest(hash_value))
+
+    def get_versions(self) -> List[Tuple[Season | Group, Video | Episode, VideoVersion]]:
+        versions = []
         for season in self.seasons:
-            version_tuple = season.get_version_by_hash(hash_type, hash_value)
-            if version_tuple:
-                (video, version) = version_tuple
-                return season, video, version
+            for video in season.get_videos():
+                versions.extend((season, video, version) for version in video.versions)
         for group in self.other_groups:
-            version_tuple = group.get_version_by_hash(hash_type, hash_value)
-            if version_tuple:
-                (video, version) = version_tuple
-                return group, video, version
-        return None
+            for video in group.videos:
+                versions.extend((group, video, version) for version in video.versions)
+        return versions
+
+    def get_hash_values(self, hash_type: str) -> Set[str]:
+        self.__check_index()
+        return {decode_digest(digest) for digest in self.__hash_index.get(hash_type, {})}
+
+    def count_versions(self, *hash_types: str) -> int:
+        # Versions that have all of the hash types
+        return sum(all(hash_type in version.hashes for hash_type in hash_types)
+                   for _, _, version in self.get_versions())
+
+    def get_season_positions(self, hash_type: str) -> Dict[Digest, int]:
+        # Position in seasons of the season that has a version with the digest
+        positions = {}
+        for position, season in enumerate(self.seasons):
+            for video in season.get_videos():
+                for version in video.versions:
+                    digest = version.hashes.get_digest(hash_type)
+                    if digest is not None:
+                        positions[digest] = position
+        return positions
 
     def __repr__(self):
         return f"EpisodeDb: {len(self.seasons)} seasons, {len(self.other_groups)} other groups"
@@ -63,11 +164,11 @@ class EpisodeDb:
         for season in dic["seasons"]:
             new_season = Season()
             new_season.from_dict(season)
-            self.seasons.append(new_season)
+            self.add_season(new_season)
         for group in dic["other_groups"]:
             new_group = Group()
             new_group.from_dict(group)
-            self.other_groups.append(new_group)
+            self.add_group(new_group)
 
     def as_dict(self):
         dic = {}
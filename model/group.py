@@ -1,16 +1,22 @@
-from typing import List, Dict, Optional, Tuple
+from typing import Dict, Optional, Tuple
 
+from model.tracked import Tracked
 from model.video import Video, VideoVersion
 
 
-class Group:
+class Group(Tracked):
+    __slots__ = ("name", "videos")
     name: str
-    videos: List[Video]
+    videos: Tuple[Video, ...]
 
     def __init__(self):
-        self.videos = []
+        super().__init__()
+        self.videos = ()
         self.name = ""
 
+    def add_video(self, video: Video):
+        self.videos = (*self.videos, video)
+
     def get_version_by_hash(self, hash_type: str, hash_value: str) -> Optional[Tuple[Video, VideoVersion]]:
         for video in self.videos:
             version = video.get_version_by_hash(hash_type, hash_value)
@@ -43,7 +49,9 @@ class Group:
 
     def from_dict(self, dic: Dict):
         self.name = dic["name"]
+        videos = []
         for video in dic["videos"]:
             vid = Video()
             vid.from_dict(video)
-            self.videos.append(vid)
+            videos.append(vid)
+        self.videos = tuple(videos)
@@ -1,32 +1,57 @@
 from typing import List, Dict, Optional, Tuple
 
 from model.episode import Episode
+from model.tracked import Tracked
 from model.video import Video, VideoVersion
 
 
-class Season:
+class Season(Tracked):
+    __slots__ = ("number", "episodes", "finale", "mid_season_finale", "name", "__episode_index")
     number: int
-    episodes: List[Episode]
+    episodes: Tuple[Episode, ...]
     finale: Optional[Video]
     mid_season_finale: Optional[Video]
     name: str
+    # Built on the first lookup after the episodes were assigned
+    __episode_index: Optional[Dict[str, Episode]]
 
     def __init__(self):
+        super().__init__()
         self.name = ""
-        self.episodes = []
+        self.episodes = ()
         self.finale = None
         self.mid_season_finale = None
         self.number = 0
 
-    def get_episode_by_number(self, episode_number: str) -> Optional[Episode]:
+    def __setattr__(self, name: str, value):
+        super().__setattr__(name, value)
+        if name == "episodes":
+            self.__episode_index = None
+
+    def rebuild_index(self):
+        self.__episode_index = {}
         for episode in self.episodes:
-            if episode.number == episode_number:
-                return episode
-        return None
+            self.__episode_index.setdefault(episode.number, episode)
+
+    def add_episode(self, episode: Episode):
+        self.episodes = (*self.episodes, episode)
+
+    def get_episode_by_number(self, episode_number: str) -> Optional[Episode]:
+        if self.__episode_index is None:
+            self.rebuild_index()
+        return self.__episode_index.get(episode_number)
 
     def get_finale(self) -> Optional[Video]:
         return self.finale
 
+    def get_videos(self) -> List[Video | Episode]:
+        videos: List[Video | Episode] = list(self.episodes)
+        if self.finale:
+            videos.append(self.finale)
+        if self.mid_season_finale:
+            videos.append(self.mid_season_finale)
+        return videos
+
     def get_version_by_hash(self, hash_type: str, hash_value: str) -> Optional[Tuple[Video | Episode, VideoVersion]]:
         for episode in self.episodes:
             version = episode.get_version_by_hash(hash_type, hash_value)
@@ -83,10 +108,12 @@ class Season:
     def from_dict(self, dic: Dict):
         self.number = dic["number"]
         self.name = dic["name"]
+        episodes = []
         for episode in dic["episodes"]:
             ep = Episode()
             ep.from_dict(episode)
-            self.episodes.append(ep)
+            episodes.append(ep)
+        self.episodes = tuple(episodes)
         if "finale" in dic:
             self.finale = Video()
             self.finale.from_dict(dic["finale"])
@@ -0,0 +1,19 @@
+from typing import Any, Callable, Optional
+
+
+class Tracked:
+    # Model object that reports every assignment to its change listener. The model collections are tuples,
+    # so adding an episode or a version is an assignment too. Private attributes are caches and not reported.
+    __slots__ = ("__change_listener",)
+    __change_listener: Optional[Callable[[], None]]
+
+    def __init__(self):
+        object.__setattr__(self, "_Tracked__change_listener", None)
+
+    def __setattr__(self, name: str, value: Any):
+        object.__setattr__(self, name, value)
+        if self.__change_listener is not None and not name.startswith("_"):
+            self.__change_listener()
+
+    def set_change_listener(self, listener: Optional[Callable[[], None]]):
+        object.__setattr__(self, "_Tracked__change_listener", listener)
@@ -1,15 +1,21 @@
 from __future__ import annotations
 
-from typing import List, Optional, Dict
+import sys
+from typing import List, Optional, Dict, Tuple
 
+from model.digest import HashMap
+from model.tracked import Tracked
 
-class Video:
+
+class Video(Tracked):
+    __slots__ = ("name", "versions")
     name: str
-    versions: List[VideoVersion]
+    versions: Tuple[VideoVersion, ...]
 
     def __init__(self):
+        super().__init__()
         self.name = ""
-        self.versions = []
+        self.versions = ()
 
     def __repr__(self):
         return f"Video: {self.name} with {len(self.versions)} versions"
@@ -42,21 +48,24 @@ class Video:
 
     def from_dict(self, dic: Dict):
         self.name = dic["name"]
-        self.versions = []
+        versions = []
         for version in dic["versions"]:
             ver = VideoVersion()
             ver.from_dict(version)
-            self.versions.append(ver)
+            versions.append(ver)
+        self.versions = tuple(versions)
 
 
 class VideoVersion:
+    __slots__ = ("tags", "hashes", "suffix")
     tags: List[str]
-    hashes: Dict[str, str]
+    # Changed in place, an EpisodeDb listens to the hashes of the versions it indexed
+    hashes: HashMap
     suffix: str
 
     def __init__(self):
         self.tags = []
-        self.hashes = {}
+        self.hashes = HashMap()
         self.suffix = ""
 
     def __repr__(self):
@@ -86,12 +95,13 @@ class VideoVersion:
         if self.tags is not None:
             dic["tags"] = self.tags
         if self.hashes is not None:
-            dic["hashes"] = self.hashes
+            dic["hashes"] = dict(self.hashes)
         if self.suffix is not None:
             dic["suffix"] = self.suffix
         return dic
 
     def from_dict(self, dic: Dict):
-        self.tags = dic.get("tags", [])
-        self.hashes = dic.get("hashes", {})
-        self.suffix = dic.get("suffix", "")
+        # The same few tags repeat across all versions
+        self.tags = [sys.intern(tag) for tag in dic.get("tags", [])]
+        self.hashes = HashMap(dic.get("hashes", {}))
+        self.suffix = sys.intern(dic.get("suffix", ""))
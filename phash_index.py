@@ -0,0 +1,113 @@
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+from hasher import HashDict
+
+PHASH_BITS = 64
+
+
+def phash_to_int(phash: str | int) -> int:
+    if isinstance(phash, int):
+        return phash
+    return int(phash, base=16)
+
+
+def hamming_distance(phash_1: int, phash_2: int) -> int:
+    return (phash_1 ^ phash_2).bit_count()
+
+
+class PhashIndex:
+    # Multi-index hashing over 64 bit phashes: the phash is split into segments and every segment gets its own
+    # table. Two phashes within distance r differ in at least one segment by at most r // segments bits, so a
+    # radius query only probes the segment values close to the query instead of comparing every phash.
+    segments: int
+    __segment_bits: int
+    __tables: List[Dict[int, List[int]]]
+    __keys_by_phash: Dict[int, List[str]]
+    __phashes: Dict[str, int]
+    __order: Dict[str, int]
+
+    def __init__(self, segments: int = 4):
+        if PHASH_BITS % segments != 0:
+            raise ValueError(f"{PHASH_BITS} bits can't be split into {segments} segments")
+        self.segments = segments
+        self.__segment_bits = PHASH_BITS // segments
+        self.__tables = [{} for _ in range(segments)]
+        self.__keys_by_phash = {}
+        self.__phashes = {}
+        self.__order = {}
+
+    @classmethod
+    def from_hash_dict(cls, hash_dict: HashDict, hash_type: str = "phash") -> "PhashIndex":
+        phash_index = cls()
+        for file_path, phash in hash_dict.get_hash_type_dict(hash_type).items():
+            phash_index.add(file_path, phash)
+        return phash_index
+
+    def __len__(self):
+        return len(self.__phashes)
+
+    def __contains__(self, key: str):
+        return key in self.__phashes
+
+    def keys(self) -> List[str]:
+        return list(self.__phashes.keys())
+
+    def get_phash(self, key: str) -> Optional[int]:
+        return self.__phashes.get(key)
+
+    def __split(self, phash: int) -> List[int]:
+        mask = (1 << self.__segment_bits) - 1
+        return [(phash >> (i * self.__segment_bits)) & mask for i in range(self.segments)]
+
+    def add(self, key: str, phash: str | int):
+        if key in self.__phashes:
+            raise KeyError(f"{key} is already indexed")
+        phash = phash_to_int(phash)
+        self.__phashes[key] = phash
+        self.__order[key] = len(self.__order)
+
+        if phash not in self.__keys_by_phash:
+            self.__keys_by_phash[phash] = []
+            for table, segment in zip(self.__tables, self.__split(phash)):
+                table.setdefault(segment, []).append(phash)
+        self.__keys_by_phash[phash].append(key)
+
+    def __segment_variants(self, segment: int, max_bits: int):
+        yield segment
+        for bit_count in range(1, max_bits + 1):
+            for bits in combinations(range(self.__segment_bits), bit_count):
+                variant = segment
+                for bit in bits:
+                    variant ^= 1 << bit
+                yield variant
+
+    def query(self, phash: str | int, max_distance: int) -> List[Tuple[str, int]]:
+        # All keys within max_distance (inclusive) of phash, in insertion order
+        matches = []
+        if max_distance < 0:
+            return matches
+        phash = phash_to_int(phash)
+        max_segment_distance = min(max_distance // self.segments, self.__segment_bits)
+
+        candidates = set()
+        for table, segment in zip(self.__tables, self.__split(phash)):
+            for variant in self.__segment_variants(segment, max_segment_distance):
+                candidates.update(table.get(variant, ()))
+
+        for candidate in candidates:
+            distance = hamming_distance(candidate, phash)
+            if distance <= max_distance:
+                matches.extend((key, distance) for key in self.__keys_by_phash[candidate])
+        matches.sort(key=lambda match: self.__order[match[0]])
+        return matches
+
+    def find_pairs(self, max_distance: int) -> List[Tuple[str, str, int]]:
+        # Every pair of keys within max_distance, each pair once with the earlier inserted key first
+        pairs = []
+        for key, phash in self.__phashes.items():
+            key_order = self.__order[key]
+            for other_key, distance in self.query(phash, max_distance):
+                if self.__order[other_key] > key_order:
+                    pairs.append((key, other_key, distance))
+        return pairs
@@ -0,0 +1,74 @@
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+from hasher import HashDict
+from model.episode_db import EpisodeDb
+from phash_index import phash_to_int
+
+# Number of uint64 distances computed per block, bounds the temporary arrays to a few MB
+DEFAULT_BLOCK_ELEMENTS = 1 << 20
+
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return POPCOUNT_TABLE[values.view(np.uint8)].reshape(*values.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+class PhashMatrix:
+    # Phashes packed into a uint64 array, keys[i] belongs to phashes[i]
+    keys: List[Any]
+    phashes: np.ndarray
+
+    def __init__(self, keys: List[Any], phashes: List[str | int]):
+        self.keys = keys
+        self.phashes = np.array([phash_to_int(phash) for phash in phashes], dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_hash_dict(cls, hash_dict: HashDict, hash_type: str = "phash") -> "PhashMatrix":
+        phash_dict = hash_dict.get_hash_type_dict(hash_type)
+        return cls(list(phash_dict.keys()), list(phash_dict.values()))
+
+    @classmethod
+    def from_episode_db(cls, db: EpisodeDb, hash_type: str = "phash") -> "PhashMatrix":
+        keys = []
+        phashes = []
+        for version_tuple in db.get_versions():
+            (_, _, version) = version_tuple
+            if hash_type in version.hashes:
+                keys.append(version_tuple)
+                phashes.append(version.hashes[hash_type])
+        return cls(keys, phashes)
+
+    def best_matches(self, references: "PhashMatrix", max_distance: int,
+                     block_elements: int = DEFAULT_BLOCK_ELEMENTS) -> List[Optional[Tuple[Any, int]]]:
+        # For every phash the closest reference key and its distance, None if nothing is within max_distance
+        best_distances = np.full(len(self), np.iinfo(np.uint8).max, dtype=np.uint8)
+        best_indices = np.zeros(len(self), dtype=np.int64)
+        if len(references) > 0:
+            ref_block = max(1, min(len(references), block_elements))
+            row_block = max(1, block_elements // ref_block)
+            for row_start in range(0, len(self), row_block):
+                rows = self.phashes[row_start:row_start + row_block]
+                for ref_start in range(0, len(references), ref_block):
+                    refs = references.phashes[ref_start:ref_start + ref_block]
+                    distances = popcount(rows[:, None] ^ refs[None, :])
+                    block_best = distances.argmin(axis=1)
+                    block_distances = distances[np.arange(len(rows)), block_best]
+                    improved = block_distances < best_distances[row_start:row_start + len(rows)]
+                    best_distances[row_start:row_start + len(rows)][improved] = block_distances[improved]
+                    best_indices[row_start:row_start + len(rows)][improved] = block_best[improved] + ref_start
+
+        matches = []
+        for index, distance in zip(best_indices.tolist(), best_distances.tolist()):
+            if distance <= max_distance:
+                matches.append((references.keys[index], distance))
+            else:
+                matches.append(None)
+        return matches
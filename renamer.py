@@ -0,0 +1,223 @@
+import json
+import os
+import re
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Dict, Set, Tuple, TextIO
+
+from epdb import format_video_string
+from hasher import HashDict
+from logger import logger
+from model import Episode, Video, VideoVersion, Season, Group
+from model.episode_db import EpisodeDb
+
+RENAME_JOURNAL_NAME = "wbch_rename.journal"
+TEMPORARY_PREFIX = ".wbch_rename_"
+# Not allowed in file names on Windows
+INVALID_CHARACTERS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+class RenameOperation(NamedTuple):
+    source: str
+    target: str
+
+
+class RenamePlan(NamedTuple):
+    # Renames of one phase don't depend on each other and run in parallel, the phases run in order
+    phases: List[List[RenameOperation]]
+    conflicts: List[str]
+
+    def rename_count(self) -> int:
+        # Chains count once, their detour over a temporary name is an implementation detail
+        return sum(1 for phase in self.phases for operation in phase
+                   if not Path(operation.target).name.startswith(TEMPORARY_PREFIX))
+
+
+def format_file_name(container: Season | Group, video: Video | Episode, version: VideoVersion, extension: str) -> str:
+    name = format_video_string(container, video).removesuffix(" - ")
+    # The suffix of a version names it, versions without one are told apart by their tags
+    if version.suffix:
+        name += version.suffix
+    elif version.tags:
+        name += f" ({' '.join(version.tags)})"
+    name = INVALID_CHARACTERS.sub("_", name).rstrip(" .")
+    return name + extension
+
+
+def plan_renames(db: EpisodeDb, hash_dict: HashDict) -> RenamePlan:
+    # Only files with an exact hash match are renamed, each one inside its own directory
+    targets: Dict[str, str] = {}
+    target_sources: Dict[str, str] = {}
+    conflicts: List[str] = []
+    for file_path, file_hash in sorted(hash_dict.get_hash_type_dict("hash").items()):
+        version_tuple = db.get_version_by_hash("hash", file_hash)
+        if not version_tuple:
+            continue
+        source = Path(file_path)
+        target = str(source.with_name(format_file_name(*version_tuple, source.suffix)))
+        if target == file_path:
+            continue
+        if os.path.normcase(target) in target_sources:
+            conflicts.append(f"'{file_path}' would also be renamed to '{target}', "
+                             f"same target as '{target_sources[os.path.normcase(target)]}'")
+            continue
+        target_sources[os.path.normcase(target)] = file_path
+        targets[file_path] = target
+
+    # A target that is the source of another rename is free once that rename ran,
+    # any other existing target would be overwritten
+    sources: Set[str] = {os.path.normcase(source) for source in targets}
+    for source, target in list(targets.items()):
+        if os.path.normcase(target) in sources or not os.path.lexists(target):
+            continue
+        if os.path.normcase(source) == os.path.normcase(target) or os.path.samefile(source, target):
+            # Only the case changes, on case insensitive file systems the target is the source itself
+            continue
+        conflicts.append(f"'{source}' can't be renamed, '{target}' already exists")
+        del targets[source]
+        sources.discard(os.path.normcase(source))
+
+    # Chains and swaps go through a temporary name so no rename waits for another one of the same phase
+    direct: List[RenameOperation] = []
+    via_temporary: List[RenameOperation] = []
+    to_target: List[RenameOperation] = []
+    for source, target in targets.items():
+        if os.path.normcase(target) in sources and os.path.normcase(target) != os.path.normcase(source):
+            temporary = str(Path(source).with_name(f"{TEMPORARY_PREFIX}{uuid.uuid4().hex}{Path(source).suffix}"))
+            via_temporary.append(RenameOperation(source, temporary))
+            to_target.append(RenameOperation(temporary, target))
+        else:
+            direct.append(RenameOperation(source, target))
+    # Sources of the chains have to be moved away before direct renames can take their names
+    phases = [phase for phase in (via_temporary, direct, to_target) if phase]
+    return RenamePlan(phases, conflicts)
+
+
+def rename_file(operation: RenameOperation) -> RenameOperation:
+    # Never overwrite, os.rename would silently replace an existing file on posix
+    if os.path.lexists(operation.target) and not (
+            os.path.normcase(operation.source) == os.path.normcase(operation.target)
+            or os.path.samefile(operation.source, operation.target)):
+        raise FileExistsError(f"Target exists: {operation.target}")
+    os.rename(operation.source, operation.target)
+    return operation
+
+
+def run_phase(phase: List[RenameOperation], hash_dict: HashDict, journal: Optional[TextIO], run_id: str,
+              phase_number: int, num_workers: int) -> Tuple[int, List[str]]:
+    renamed = 0
+    errors: List[str] = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending: Dict[Future, RenameOperation] = {}
+        operations = iter(phase)
+        while True:
+            # Bounded window, tens of thousands of renames are not queued at once
+            for operation in operations:
+                pending[executor.submit(rename_file, operation)] = operation
+                if len(pending) >= 4 * num_workers:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                operation = pending.pop(future)
+                try:
+                    future.result()
+                except OSError as e:
+                    errors.append(f"Can't rename '{operation.source}' to '{operation.target}': {e}")
+                    continue
+                renamed += 1
+                # Paths are rewritten in the index, the content and so the hashes are unchanged
+                hash_dict.move_file(operation.source, operation.target)
+                if journal:
+                    journal.write(json.dumps({"run": run_id, "phase": phase_number, "source": operation.source,
+                                              "target": operation.target}) + "\n")
+    if journal:
+        journal.flush()
+        os.fsync(journal.fileno())
+    return renamed, errors
+
+
+def apply_plan(plan: RenamePlan, hash_dict: HashDict, journal_path: Optional[Path], num_workers: int = 8) -> int:
+    renamed = 0
+    # Runs are appended to the same journal, the id keeps equal phase numbers of different runs apart
+    run_id = uuid.uuid4().hex
+    journal = open(journal_path, "a") if journal_path else None
+    try:
+        for phase_number, phase in enumerate(plan.phases):
+            phase_renamed, errors = run_phase(phase, hash_dict, journal, run_id, phase_number, num_workers)
+            renamed += phase_renamed
+            for error in errors:
+                logger.error(error)
+            if errors and phase_number + 1 < len(plan.phases):
+                # Later phases rely on the names this phase should have freed
+                logger.error("Stopping the rename, undo it with --undo_rename")
+                break
+    finally:
+        if journal:
+            journal.close()
+        hash_dict.flush()
+    return renamed
+
+
+def undo_renames(journal_path: Path, hash_dict: HashDict, num_workers: int = 8) -> int:
+    if not journal_path.exists():
+        logger.warn(f"No rename journal found: {journal_path}")
+        return 0
+
+    operations: List[Tuple[Tuple[Optional[str], int], RenameOperation]] = []
+    with open(journal_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warn(f"Ignoring incomplete rename journal entry in: {journal_path}")
+                break
+            # Journals written before run ids existed hold a single run
+            operations.append(((entry.get("run"), entry["phase"]), RenameOperation(entry["source"], entry["target"])))
+
+    # Runs are appended to the journal, every run and phase is undone in reverse order
+    phases: List[List[RenameOperation]] = []
+    last_phase = None
+    for phase_key, operation in reversed(operations):
+        if phase_key != last_phase:
+            phases.append([])
+            last_phase = phase_key
+        phases[-1].append(RenameOperation(operation.target, operation.source))
+
+    renamed = apply_plan(RenamePlan(phases, []), hash_dict, None, num_workers)
+    if renamed == len(operations):
+        journal_path.unlink()
+    else:
+        logger.error(f"Undid {renamed} of {len(operations)} renames, the journal is kept: {journal_path}")
+    return renamed
+
+
+def print_plan(plan: RenamePlan, root_folder: Path, output: Optional[TextIO] = None):
+    print("\n✏️  Rename Plan", file=output)
+    temporary_sources: Dict[str, str] = {}
+    for phase in plan.phases:
+        for operation in phase:
+            if Path(operation.target).name.startswith(TEMPORARY_PREFIX):
+                temporary_sources[operation.target] = operation.source
+                continue
+            source = temporary_sources.get(operation.source, operation.source)
+            print(f"\t'{Path(source).relative_to(root_folder)}' -> '{Path(operation.target).name}'", file=output)
+    for conflict in plan.conflicts:
+        print(f"\t⚠️ {conflict}", file=output)
+    print(f"\n{plan.rename_count()} files to rename, {len(plan.conflicts)} conflicts", file=output)
+
+
+def confirm_plan(plan: RenamePlan, output: Optional[TextIO] = None) -> bool:
+    if sys.stdin and sys.stdin.isatty():
+        # input() would write the prompt to stdout
+        print("Rename the files? [y/N] ", end="", file=output, flush=True)
+        return input().strip().lower() in ("y", "yes")
+    try:
+        from messagebox import ask_rename
+    except ImportError:
+        logger.warn("Can't ask for confirmation, rerun in a terminal or with --yes")
+        return False
+    return ask_rename()
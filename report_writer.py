@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, Optional, TextIO, Tuple, Any
+
+from epdb import match_version, format_episode_code
+from hasher import HashDict
+from model.episode_db import EpisodeDb
+
+REPORT_FORMATS = ("text", "jsonl", "csv")
+REPORT_SUFFIXES = {"jsonl": ".jsonl", "csv": ".csv"}
+# One column per field of both record types, fields a record type doesn't have stay empty in csv
+RECORD_FIELDS = ("record", "season", "episode", "episode_type", "name", "tags", "status", "match_type", "path",
+                 "phash_distance", "duplicates", "found", "fuzzy", "total", "completion")
+STATUS_BY_MATCH_TYPE = {"exact": "found", "fuzzy": "found", "missing": "missing"}
+
+
+def iter_report_records(db: EpisodeDb, hashes: HashDict, root_folder: Path,
+                        fuzzy_hash_to_file_dict: Optional[Dict[str, Tuple[str, int]]] = None
+                        ) -> Iterator[Dict[str, Any]]:
+    # One record per version in report order, then a summary record
+    fuzzy_hash_to_file_dict = fuzzy_hash_to_file_dict or {}
+    found_count = 0
+    fuzzy_count = 0
+    total_count = 0
+    for season_data in db.seasons:
+        episodes = [(episode, 'regular') for episode in season_data.episodes]
+        episodes += [(season_data.finale, 'finale'), (season_data.mid_season_finale, 'msf')]
+        for episode, episode_type in episodes:
+            if not episode:
+                continue
+            for version in episode.versions:
+                match_type, version_files, distance = match_version(version, hashes, fuzzy_hash_to_file_dict)
+                total_count += 1
+                found_count += match_type != "missing"
+                fuzzy_count += match_type == "fuzzy"
+                yield {
+                    "record": "version",
+                    "season": season_data.number,
+                    "episode": format_episode_code(episode, season_data.number, episode_type),
+                    "episode_type": episode_type,
+                    "name": episode.name,
+                    "tags": list(version.tags),
+                    "status": STATUS_BY_MATCH_TYPE[match_type],
+                    "match_type": match_type,
+                    "path": version_files[0].relative_to(root_folder).as_posix() if version_files else None,
+                    "phash_distance": distance,
+                    "duplicates": [file.relative_to(root_folder).as_posix() for file in version_files[1:]],
+                }
+    yield {
+        "record": "summary",
+        "found": found_count,
+        "fuzzy": fuzzy_count,
+        "total": total_count,
+        "completion": round(found_count / total_count, 4) if total_count else None,
+    }
+
+
+class JsonLinesWriter:
+    __output: TextIO
+
+    def __init__(self, output: TextIO):
+        self.__output = output
+
+    def write(self, record: Dict[str, Any]):
+        self.__output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class CsvWriter:
+    __writer: csv.DictWriter
+
+    def __init__(self, output: TextIO):
+        self.__writer = csv.DictWriter(output, fieldnames=RECORD_FIELDS)
+        self.__writer.writeheader()
+
+    def write(self, record: Dict[str, Any]):
+        row = {field: "" if value is None else value for field, value in record.items()}
+        # Tags never contain spaces, paths may, so duplicate paths are separated by "|"
+        if "tags" in row:
+            row["tags"] = " ".join(row["tags"])
+        if "duplicates" in row:
+            row["duplicates"] = "|".join(row["duplicates"])
+        self.__writer.writerow(row)
+
+
+def default_report_output(root_folder: Path, report_format: str) -> Path:
+    return root_folder / f"wbch_report{REPORT_SUFFIXES[report_format]}"
+
+
+def write_report_records(db: EpisodeDb, hashes: HashDict, root_folder: Path, report_format: str, output_path: str,
+                         fuzzy_hash_to_file_dict: Optional[Dict[str, Tuple[str, int]]] = None) -> int:
+    # Records are written as they are produced, "-" streams them to stdout.
+    # A file is written next to the old one and swapped in, readers never see half a report.
+    if output_path == "-":
+        return write_records(iter_report_records(db, hashes, root_folder, fuzzy_hash_to_file_dict), report_format,
+                             sys.stdout)
+
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        count = write_records(iter_report_records(db, hashes, root_folder, fuzzy_hash_to_file_dict), report_format, f)
+    os.replace(tmp_path, output_path)
+    return count
+
+
+def write_records(records: Iterator[Dict[str, Any]], report_format: str, output: TextIO) -> int:
+    writer = JsonLinesWriter(output) if report_format == "jsonl" else CsvWriter(output)
+    count = 0
+    for record in records:
+        writer.write(record)
+        count += 1
+    output.flush()
+    return count
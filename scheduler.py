@@ -0,0 +1,244 @@
+import os
+from collections import deque, Counter
+from concurrent.futures import Executor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple, Set
+
+from hasher import Hasher
+from logger import logger
+from worker_pool import WorkerPool, hash_batch
+
+HDD_READERS = 1
+SSD_READERS = 4
+# Network mounts have no block device, concurrent requests hide their latency
+NETWORK_READERS = 4
+DEFAULT_READERS = 2
+READERS_BY_KIND = {"hdd": HDD_READERS, "ssd": SSD_READERS, "network": NETWORK_READERS, "memory": SSD_READERS,
+                   "unknown": DEFAULT_READERS}
+# Upper bound for the disk bound pool across all devices
+IO_POOL_WORKERS = 16
+# Files of one hasher that may wait for a single device while the walk looks ahead for files of idle devices
+DEVICE_LOOKAHEAD_FILES = 256
+MOUNTINFO_PATH = Path("/proc/self/mountinfo")
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "davfs",
+                       "fuse.sshfs", "fuse.rclone", "fuse.s3fs")
+MEMORY_FILESYSTEMS = ("tmpfs", "ramfs")
+
+
+def read_mounts() -> Dict[str, Tuple[str, str]]:
+    # "major:minor" -> (filesystem type, mount source), the fields after " - " in mountinfo
+    mounts = {}
+    try:
+        with open(MOUNTINFO_PATH, "r") as f:
+            for line in f:
+                fields, separator, filesystem_fields = line.partition(" - ")
+                fields, filesystem_fields = fields.split(), filesystem_fields.split()
+                if separator and len(fields) > 2 and len(filesystem_fields) > 1:
+                    mounts.setdefault(fields[2], (filesystem_fields[0], filesystem_fields[1]))
+    except OSError:
+        pass
+    return mounts
+
+
+def detect_device_kind(device: int) -> str:
+    # "hdd", "ssd", "network", "memory" or "unknown"
+    if not hasattr(os, "major"):
+        return "unknown"
+    major, minor = os.major(device), os.minor(device)
+    # Network shares, btrfs, ZFS, overlayfs and tmpfs all report major 0, only the filesystem type tells them apart
+    filesystem_type, source = read_mounts().get(f"{major}:{minor}", ("", ""))
+    if filesystem_type in NETWORK_FILESYSTEMS:
+        return "network"
+    if filesystem_type in MEMORY_FILESYSTEMS:
+        return "memory"
+    if major == 0:
+        # A btrfs mount names its disk as the source, a ZFS pool or an overlay doesn't
+        try:
+            source_device = os.stat(source).st_rdev if source.startswith("/dev/") else 0
+        except OSError:
+            source_device = 0
+        if not source_device:
+            return "unknown"
+        major, minor = os.major(source_device), os.minor(source_device)
+    return detect_block_device_kind(major, minor)
+
+
+def detect_block_device_kind(major: int, minor: int) -> str:
+    # Partitions have no queue of their own, the rotational flag is on the parent disk
+    block_path = Path(f"/sys/dev/block/{major}:{minor}")
+    try:
+        block_path = block_path.resolve(strict=True)
+    except OSError:
+        return "unknown"
+    for rotational_path in (block_path / "queue" / "rotational", block_path.parent / "queue" / "rotational"):
+        try:
+            rotational = rotational_path.read_text().strip()
+        except OSError:
+            continue
+        return "hdd" if rotational == "1" else "ssd"
+    return "unknown"
+
+
+def detect_readers_per_device(device: int) -> int:
+    return READERS_BY_KIND[detect_device_kind(device)]
+
+
+def default_cpu_workers() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class HashScheduler:
+    # Runs several hashers at once. Disk bound jobs are queued per device with a cap on concurrent readers,
+    # so a HDD is read by one worker at a time while SSDs and network mounts are read in parallel.
+    # Cpu bound jobs run on their own pool sized to the core count. They decode the whole file, so on a HDD
+    # they take one of its readers as well.
+    # The pools are kept between runs, close the scheduler once hashing is over.
+    readers_per_device: Optional[int]
+    cpu_workers: int
+    worker_pool: WorkerPool
+    __device_kinds: Dict[int, str]
+
+    def __init__(self, readers_per_device: Optional[int] = None, cpu_workers: Optional[int] = None):
+        self.readers_per_device = readers_per_device
+        self.cpu_workers = cpu_workers or default_cpu_workers()
+        # Workers are started on demand, the per device limits decide how many actually read at once.
+        # readers_per_device is a limit per disk, the pool is shared by all of them.
+        self.worker_pool = WorkerPool(max(IO_POOL_WORKERS, readers_per_device or 0), self.cpu_workers)
+        self.__device_kinds = {}
+
+    def close(self):
+        self.worker_pool.shutdown()
+
+    def __enter__(self) -> "HashScheduler":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_device_kind(self, device: int) -> str:
+        if device not in self.__device_kinds:
+            self.__device_kinds[device] = detect_device_kind(device)
+            logger.info(f"Device {device} is {self.__device_kinds[device]}, "
+                        f"using {self.get_device_readers(device)} readers")
+        return self.__device_kinds[device]
+
+    def get_device_readers(self, device: int) -> int:
+        if self.readers_per_device:
+            return self.readers_per_device
+        return READERS_BY_KIND[self.get_device_kind(device)]
+
+    def run(self, hashers: List[Hasher]):
+        # Waiting files per device, disk bound and cpu bound ones apart
+        io_queues: Dict[int, Deque[Tuple[Hasher, Path]]] = {}
+        cpu_queues: Dict[int, Deque[Tuple[Hasher, Path]]] = {}
+        # Files are pulled from the hashers while hashing, a hasher is fed until its files are all queued
+        feeding: List[Hasher] = list(hashers)
+        queued: Dict[Hasher, int] = {hasher: 0 for hasher in hashers}
+        device_queued: Dict[Hasher, Counter] = {hasher: Counter() for hasher in hashers}
+        for hasher in hashers:
+            logger.info(f"Hashing files with hasher: {', '.join(sorted(hasher.hash_names))}")
+            hasher.begin()
+
+        device_in_flight: Counter = Counter()
+        cpu_in_flight = 0
+        # Hasher, device and whether the job holds one of the device's readers
+        pending: Dict[Future, Tuple[Hasher, int, bool]] = {}
+
+        def can_read(device: int) -> bool:
+            return device_in_flight[device] < self.get_device_readers(device)
+
+        def holds_reader(hasher: Hasher, device: int) -> bool:
+            return hasher.io_bound or self.get_device_kind(device) == "hdd"
+
+        def has_idle_worker(hasher: Hasher) -> bool:
+            # A worker is free and none of the waiting files can use it, the next files may be for an idle device
+            if hasher.io_bound:
+                return sum(device_in_flight.values()) < self.worker_pool.io_workers and \
+                    not any(queue and can_read(device) for device, queue in io_queues.items())
+            return cpu_in_flight < 2 * self.cpu_workers and \
+                not any(queue and (not holds_reader(queue[0][0], device) or can_read(device))
+                        for device, queue in cpu_queues.items())
+
+        def wants_files(hasher: Hasher) -> bool:
+            if queued[hasher] < hasher.max_in_flight:
+                return True
+            # Every device has its own limit, a slow disk holds back the walk only once its files pile up
+            if max(device_queued[hasher].values(), default=0) >= DEVICE_LOOKAHEAD_FILES * hasher.batch_size:
+                return False
+            return has_idle_worker(hasher)
+
+        def pull_files() -> bool:
+            pulled = False
+            for hasher in list(feeding):
+                while wants_files(hasher):
+                    file_path = hasher.next_file()
+                    if file_path is None:
+                        feeding.remove(hasher)
+                        break
+                    device = hasher.hash_dict.get_file_stat(file_path).device
+                    queues = io_queues if hasher.io_bound else cpu_queues
+                    queues.setdefault(device, deque()).append((hasher, file_path))
+                    queued[hasher] += 1
+                    device_queued[hasher][device] += 1
+                    pulled = True
+            return pulled
+
+        def submit(queue: Deque[Tuple[Hasher, Path]], device: int, executor: Executor):
+            hasher, jobs = self.__take_batch(queue)
+            queued[hasher] -= len(jobs)
+            device_queued[hasher][device] -= len(jobs)
+            holds = holds_reader(hasher, device)
+            if holds:
+                device_in_flight[device] += 1
+            pending[executor.submit(hash_batch, hasher.hash_function, jobs)] = (hasher, device, holds)
+
+        def submit_jobs() -> bool:
+            nonlocal cpu_in_flight
+            submitted = False
+            for device, queue in io_queues.items():
+                while queue and can_read(device):
+                    submit(queue, device, self.worker_pool.io_executor)
+                    submitted = True
+            # Keep the cpu pool busy without queueing the whole library, the devices take turns
+            while cpu_in_flight < 2 * self.cpu_workers:
+                ready = [(device, queue) for device, queue in cpu_queues.items()
+                         if queue and (not holds_reader(queue[0][0], device) or can_read(device))]
+                if not ready:
+                    break
+                for device, queue in ready[:2 * self.cpu_workers - cpu_in_flight]:
+                    submit(queue, device, self.worker_pool.cpu_executor)
+                    cpu_in_flight += 1
+                    submitted = True
+            return submitted
+
+        while True:
+            while pull_files() | submit_jobs():
+                pass
+            if not pending:
+                break
+            done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                hasher, device, holds = pending.pop(future)
+                if holds:
+                    device_in_flight[device] -= 1
+                if not hasher.io_bound:
+                    cpu_in_flight -= 1
+                for file_path, file_hashes in future.result():
+                    hasher.store_hashes(file_path, file_hashes)
+
+        for hasher in hashers:
+            if not hasher.file_count:
+                logger.info(f"No files to hash with hasher: {', '.join(sorted(hasher.hash_names))}")
+            hasher.end()
+
+    @staticmethod
+    def __take_batch(queue: Deque[Tuple[Hasher, Path]]) -> Tuple[Hasher, List[Tuple[Path, Set[str]]]]:
+        # Consecutive files of the same hasher are sent as one task, up to its batch size
+        hasher, file_path = queue.popleft()
+        jobs = [(file_path, hasher.missing_hash_names[file_path])]
+        while queue and len(jobs) < hasher.batch_size and queue[0][0] is hasher:
+            _, file_path = queue.popleft()
+            jobs.append((file_path, hasher.missing_hash_names[file_path]))
+        return hasher, jobs
@@ -0,0 +1,114 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import pytest
+
+from epdb import download_epdb
+
+EPDB_CONTENT = json.dumps({"seasons": [], "other_groups": []}).encode()
+ETAG = '"epdb-1"'
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class EpdbServer(ThreadingHTTPServer):
+    # Stand-in for the epdb host, answers conditional requests like a static file server
+    content: bytes
+    requests: List[Dict[str, str]]
+
+    def __init__(self, content: bytes):
+        super().__init__(("127.0.0.1", 0), EpdbHandler)
+        self.content = content
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/epdb.json"
+
+
+class EpdbHandler(BaseHTTPRequestHandler):
+    server: EpdbServer
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == ETAG or self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    epdb_server = EpdbServer(EPDB_CONTENT)
+    thread = threading.Thread(target=epdb_server.serve_forever, daemon=True)
+    thread.start()
+    yield epdb_server
+    epdb_server.shutdown()
+    epdb_server.server_close()
+
+
+def unused_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}/epdb.json"
+
+
+def test_download_stores_db_and_validators(server, tmp_path):
+    file_path = tmp_path / "epdb.json"
+    assert download_epdb(file_path, server.url) == file_path
+    assert file_path.read_bytes() == EPDB_CONTENT
+    metadata = json.loads((tmp_path / "epdb.json.meta").read_text())
+    assert metadata == {"url": server.url, "etag": ETAG, "last_modified": LAST_MODIFIED}
+    assert "If-None-Match" not in server.requests[0]
+
+
+def test_not_modified_keeps_cached_db(server, tmp_path):
+    file_path = tmp_path / "epdb.json"
+    download_epdb(file_path, server.url)
+    # A changed server copy shows whether the cached file was replaced
+    server.content = b'{"seasons": [1], "other_groups": []}'
+    assert download_epdb(file_path, server.url) == file_path
+    assert server.requests[-1]["If-None-Match"] == ETAG
+    assert server.requests[-1]["If-Modified-Since"] == LAST_MODIFIED
+    assert file_path.read_bytes() == EPDB_CONTENT
+
+
+def test_validators_of_another_url_are_not_sent(server, tmp_path):
+    file_path = tmp_path / "epdb.json"
+    download_epdb(file_path, server.url)
+    server.content = b'{"seasons": [], "other_groups": [{}]}'
+    download_epdb(file_path, server.url.replace("epdb.json", "other.json"))
+    assert "If-None-Match" not in server.requests[-1]
+    assert file_path.read_bytes() == server.content
+
+
+def test_invalid_json_keeps_cached_db(server, tmp_path):
+    file_path = tmp_path / "epdb.json"
+    download_epdb(file_path, server.url)
+    (tmp_path / "epdb.json.meta").unlink()
+    server.content = b"<html>rate limited</html>"
+    assert download_epdb(file_path, server.url) == file_path
+    assert file_path.read_bytes() == EPDB_CONTENT
+
+
+def test_connection_error_falls_back_to_cached_db(tmp_path):
+    file_path = tmp_path / "epdb.json"
+    file_path.write_bytes(EPDB_CONTENT)
+    assert download_epdb(file_path, unused_url()) == file_path
+    assert file_path.read_bytes() == EPDB_CONTENT
+
+
+def test_connection_error_without_cached_db(tmp_path):
+    assert download_epdb(tmp_path / "epdb.json", unused_url()) is None
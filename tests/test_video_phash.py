@@ -0,0 +1,34 @@
+import subprocess
+from pathlib import Path
+from shutil import which
+
+import pytest
+
+pytest.importorskip("videohash2")
+if not which("ffmpeg"):
+    pytest.skip("ffmpeg is not on the system path", allow_module_level=True)
+
+from hasher import phash_file_videohash2
+from video_phash import video_phash
+
+# Moving test patterns with scene changes, so the collage tiles and the wavelet hash differ between clips
+CLIP_SOURCES = (
+    "testsrc2=size=320x240:rate=25",
+    "mandelbrot=size=320x240:rate=25",
+    "life=seed=7:size=320x240:rate=25:mold=10",
+)
+
+
+def create_clip(file_path: Path, source: str, seconds: int = 12):
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", source, "-t", str(seconds),
+                    "-c:v", "mpeg4", "-q:v", "5", "-fflags", "+bitexact", "-flags:v", "+bitexact", str(file_path)],
+                   check=True)
+
+
+@pytest.mark.parametrize("source", CLIP_SOURCES)
+def test_video_phash_matches_videohash2(source, tmp_path):
+    # The epdb phash values were made with videohash2, the in memory pipeline has to produce the same bits
+    file_path = tmp_path / "clip.mp4"
+    create_clip(file_path, source)
+    expected = phash_file_videohash2(file_path, work_dir=tmp_path)[1]["phash"]
+    assert video_phash(file_path) == expected
@@ -0,0 +1,191 @@
+import io
+import shlex
+import os
+import subprocess
+from math import ceil, floor, sqrt
+from pathlib import Path
+from shutil import which
+from typing import List, Optional
+
+# Reimplements the videohash2 VideoHash pipeline without its storage directory. Frames are piped out of ffmpeg
+# as the same mjpeg images videohash2 writes to disk and the collage and tiles are built in memory, so the
+# resulting hashes are identical to the phash values in the epdb.
+FRAME_SIZE = 144
+COLLAGE_WIDTH = 1024
+TILE_GRID = 8
+DOMINANT_COLOUR_PIXELS = "r" * 16 + "g" * 16 + "b" * 16 + "l" * 16
+# Frames sampled by the sparse phash, a square number keeps the collage rows full
+SPARSE_SAMPLES = 36
+
+
+class VideoPhashError(Exception):
+    pass
+
+
+def get_ffmpeg_path() -> str:
+    ffmpeg_path = which("ffmpeg")
+    if not ffmpeg_path:
+        raise VideoPhashError("FFmpeg is not on the system path")
+    return str(ffmpeg_path)
+
+
+def split_jpeg_stream(stream: bytes) -> List[bytes]:
+    images = []
+    start = 0
+    while start < len(stream):
+        if stream[start:start + 2] != b"\xff\xd8":
+            raise VideoPhashError("Invalid jpeg stream from ffmpeg")
+        position = start + 2
+        while True:
+            position = stream.index(b"\xff", position)
+            marker = stream[position + 1]
+            if marker == 0xD9:
+                position += 2
+                break
+            if marker == 0x00 or marker == 0xFF or 0xD0 <= marker <= 0xD7:
+                # Stuffed byte, fill byte or restart marker inside the entropy coded data
+                position += 1 if marker == 0xFF else 2
+                continue
+            # Marker segments carry their length, this skips tables that may contain 0xff
+            position += 2 + int.from_bytes(stream[position + 2:position + 4], "big")
+        images.append(stream[start:position])
+        start = position
+    return images
+
+
+def detect_crop(file_path: Path, ffmpeg_path: str, duration: float) -> List[str]:
+    from videohash2.framesextractor import FramesExtractor
+
+    # Same crop detection as videohash2, it is called with shell quoted arguments on posix
+    video_path = str(file_path)
+    quoted_ffmpeg_path = ffmpeg_path
+    if os.name == "posix":
+        video_path = shlex.quote(video_path)
+        quoted_ffmpeg_path = shlex.quote(ffmpeg_path)
+    return FramesExtractor.detect_crop(video_path=video_path, frames=3, ffmpeg_path=quoted_ffmpeg_path,
+                                       video_length=duration)
+
+
+def extract_frames(file_path: Path, frame_interval: float, ffmpeg_path: str, duration: float) -> List[bytes]:
+    crop = detect_crop(file_path, ffmpeg_path, duration)
+    command = [
+        ffmpeg_path, "-i", str(file_path), *crop, "-s", f"{FRAME_SIZE}x{FRAME_SIZE}", "-r", str(frame_interval),
+        "-f", "image2pipe", "-c:v", "mjpeg", "pipe:1"
+    ]
+    process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frames = split_jpeg_stream(process.stdout)
+    if not frames:
+        raise VideoPhashError(f"FFmpeg could not extract any frames from: {file_path}\n"
+                              f"{process.stderr.decode(errors='replace')}")
+    return frames
+
+
+def extract_keyframes(file_path: Path, samples: int, ffmpeg_path: str, duration: float) -> List[bytes]:
+    # Every sample is its own input seeked to the keyframe before its timestamp, so only one frame per
+    # sample is decoded. The single frames are concatenated and piped out by one ffmpeg process.
+    crop = detect_crop(file_path, ffmpeg_path, duration)
+    crop_filter = f"{crop[1]}," if crop else ""
+    command = [ffmpeg_path]
+    filters = []
+    for sample in range(samples):
+        timestamp = duration * (sample + 0.5) / samples
+        command += ["-noaccurate_seek", "-ss", f"{timestamp:.3f}", "-i", str(file_path)]
+        filters.append(f"[{sample}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS,{crop_filter}"
+                       f"scale={FRAME_SIZE}:{FRAME_SIZE},setsar=1[v{sample}]")
+    filters.append("".join(f"[v{sample}]" for sample in range(samples)) +
+                   f"concat=n={samples}:v=1:a=0,setpts=N/TB[frames]")
+    command += ["-filter_complex", ";".join(filters), "-map", "[frames]", "-fps_mode", "passthrough",
+                "-f", "image2pipe", "-c:v", "mjpeg", "pipe:1"]
+    process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frames = split_jpeg_stream(process.stdout)
+    if not frames:
+        raise VideoPhashError(f"FFmpeg could not extract any keyframes from: {file_path}\n"
+                              f"{process.stderr.decode(errors='replace')}")
+    return frames
+
+
+def make_collage(frames: List[bytes]):
+    from PIL import Image
+
+    images_per_row = int(round(sqrt(len(frames))))
+    with Image.open(io.BytesIO(frames[0])) as first_frame:
+        frame_width, frame_height = first_frame.size
+    scale = COLLAGE_WIDTH / (images_per_row * frame_width)
+    scaled_width = ceil(frame_width * scale)
+    scaled_height = ceil(frame_height * scale)
+    number_of_rows = ceil(len(frames) / images_per_row)
+    collage = Image.new("RGB", (COLLAGE_WIDTH, ceil(scale * frame_height * number_of_rows)))
+
+    x = 0
+    for count, frame_bytes in enumerate(frames):
+        if count % images_per_row == 0:
+            x = 0
+        with Image.open(io.BytesIO(frame_bytes)) as frame:
+            frame.thumbnail((scaled_width, scaled_height), Image.Resampling.LANCZOS)
+            collage.paste(frame, (x, (count // images_per_row) * scaled_height))
+        x += scaled_width
+
+    # videohash2 hashes the collage after a round trip through a jpeg file
+    collage_jpeg = io.BytesIO()
+    collage.save(collage_jpeg, "JPEG")
+    collage_jpeg.seek(0)
+    return Image.open(collage_jpeg)
+
+
+def dominant_colours(frames: List[bytes]) -> List[str]:
+    # The frames side by side are cut into an 8x8 grid of tiles. Only the frames overlapping a tile column
+    # are pasted, which avoids holding an image as wide as all frames together.
+    from PIL import Image
+    from imagedominantcolour import DominantColour
+
+    with Image.open(io.BytesIO(frames[0])) as first_frame:
+        frame_width, frame_height = first_frame.size
+    total_width = frame_width * len(frames)
+    tile_width, tile_height = floor(total_width / TILE_GRID), floor(frame_height / TILE_GRID)
+
+    tiles = {}
+    for column, x_start in enumerate(range(0, total_width - TILE_GRID, tile_width)):
+        strip = Image.new("RGB", (tile_width, frame_height))
+        first_frame_index = x_start // frame_width
+        last_frame_index = min(len(frames) - 1, (x_start + tile_width - 1) // frame_width)
+        for frame_index in range(first_frame_index, last_frame_index + 1):
+            with Image.open(io.BytesIO(frames[frame_index])) as frame:
+                strip.paste(frame, (frame_index * frame_width - x_start, 0))
+        for row, y_start in enumerate(range(0, frame_height - TILE_GRID, tile_height)):
+            tiles[(row, column)] = strip.crop((0, y_start, tile_width, y_start + tile_height))
+
+    colours = []
+    for position in sorted(tiles.keys()):
+        tile_png = io.BytesIO()
+        tiles[position].save(tile_png, "PNG")
+        tile_png.seek(0)
+        colours.append(DominantColour(tile_png).dominant_colour)
+    return colours
+
+
+def video_phash(file_path: Path, frame_interval: float = 0.5, ffmpeg_path: Optional[str] = None) -> str:
+    from videohash2.videoduration import video_duration
+
+    ffmpeg_path = ffmpeg_path or get_ffmpeg_path()
+    duration = video_duration(path=str(file_path), ffmpeg_path=ffmpeg_path)
+    return phash_frames(extract_frames(file_path, frame_interval, ffmpeg_path, duration))
+
+
+def sparse_video_phash(file_path: Path, samples: int = SPARSE_SAMPLES, ffmpeg_path: Optional[str] = None) -> str:
+    # Not comparable with video_phash, the collage is made of a fixed number of keyframes
+    from videohash2.videoduration import video_duration
+
+    ffmpeg_path = ffmpeg_path or get_ffmpeg_path()
+    duration = video_duration(path=str(file_path), ffmpeg_path=ffmpeg_path)
+    return phash_frames(extract_keyframes(file_path, samples, ffmpeg_path, duration))
+
+
+def phash_frames(frames: List[bytes]) -> str:
+    import imagehash
+
+    whash_bits = [bit for row in imagehash.whash(make_collage(frames)).hash.astype(int).tolist() for bit in row]
+    colours = dominant_colours(frames)
+    bits = "".join(
+        "1" if (DOMINANT_COLOUR_PIXELS[i] == colours[i]) != bool(whash_bits[i]) else "0" for i in range(64)
+    )
+    return hex(int(bits, 2))
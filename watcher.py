@@ -0,0 +1,246 @@
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from file_management import walk_files, is_video_file, is_excluded, DEFAULT_EXCLUDE_PATTERNS
+from hasher import FileStat
+from logger import logger
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_BUFFER_SIZE = 64 * 1024
+
+
+class WatchEvent(NamedTuple):
+    # kind is "changed", "removed", "moved" or "rescan" when events were lost
+    kind: str
+    path: str
+    old_path: Optional[str] = None
+    is_dir: bool = False
+
+
+class Watcher(ABC):
+    base_path: Path
+    exclude_patterns: Tuple[str, ...]
+    follow_symlinks: bool
+
+    def __init__(self, base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+                 follow_symlinks: bool = False):
+        self.base_path = Path(base_path)
+        self.exclude_patterns = tuple(exclude_patterns)
+        self.follow_symlinks = follow_symlinks
+
+    def is_watched(self, path: str) -> bool:
+        try:
+            relative_path = Path(path).relative_to(self.base_path).as_posix()
+        except ValueError:
+            return False
+        return not any(is_excluded(part, relative_path, self.exclude_patterns)
+                       for part in Path(relative_path).parts)
+
+    def scan_directory(self, directory: str) -> List[WatchEvent]:
+        return [WatchEvent("changed", entry.path)
+                for entry in walk_files(directory, self.exclude_patterns, self.follow_symlinks)]
+
+    @abstractmethod
+    def events(self, timeout: float) -> List[WatchEvent]:
+        pass
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    __libc: ctypes.CDLL
+    __fd: int
+    __watch_paths: Dict[int, str]
+
+    def __init__(self, base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+                 follow_symlinks: bool = False):
+        super().__init__(base_path, exclude_patterns, follow_symlinks)
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.__watch_paths = {}
+        self.__add_watches(str(self.base_path))
+        logger.info(f"Watching {len(self.__watch_paths)} directories with inotify")
+
+    def __add_watch(self, directory: str):
+        mask = WATCH_MASK if self.follow_symlinks else WATCH_MASK | IN_DONT_FOLLOW
+        watch_descriptor = self.__libc.inotify_add_watch(self.__fd, os.fsencode(directory), mask)
+        if watch_descriptor < 0:
+            # Usually fs.inotify.max_user_watches is too low for the collection
+            logger.warn(f"Can't watch directory {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.__watch_paths[watch_descriptor] = directory
+
+    def __add_watches(self, directory: str):
+        self.__add_watch(directory)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.warn(f"Can't read directory {directory}: {e}")
+            return
+        for entry in entries:
+            if not self.is_watched(entry.path) or (not self.follow_symlinks and entry.is_symlink()):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                    self.__add_watches(entry.path)
+            except OSError:
+                continue
+
+    def __move_watches(self, old_directory: str, new_directory: str):
+        for watch_descriptor, directory in self.__watch_paths.items():
+            if directory == old_directory or directory.startswith(old_directory + os.sep):
+                self.__watch_paths[watch_descriptor] = new_directory + directory[len(old_directory):]
+
+    def __read_events(self, timeout: float) -> List[Tuple[int, int, int, str]]:
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.__fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        raw_events = []
+        offset = 0
+        while offset < len(buffer):
+            watch_descriptor, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            raw_events.append((watch_descriptor, mask, cookie, name))
+        return raw_events
+
+    def events(self, timeout: float) -> List[WatchEvent]:
+        events: List[WatchEvent] = []
+        # Renames arrive as a moved from and moved to pair with the same cookie
+        moved_from: Dict[int, Tuple[str, bool]] = {}
+        for watch_descriptor, mask, cookie, name in self.__read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                logger.warn("Too many file system events, rescanning the collection")
+                events.append(WatchEvent("rescan", str(self.base_path)))
+                continue
+            if mask & IN_IGNORED:
+                self.__watch_paths.pop(watch_descriptor, None)
+                continue
+            directory = self.__watch_paths.get(watch_descriptor)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if not self.is_watched(path) or (not is_dir and not is_video_file(name)):
+                continue
+
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO:
+                old_path, _ = moved_from.pop(cookie, (None, is_dir))
+                if old_path is None:
+                    # Moved into the collection from somewhere else
+                    if is_dir:
+                        self.__add_watches(path)
+                        events.extend(self.scan_directory(path))
+                    else:
+                        events.append(WatchEvent("changed", path))
+                    continue
+                if is_dir:
+                    self.__move_watches(old_path, path)
+                events.append(WatchEvent("moved", path, old_path, is_dir))
+            elif mask & IN_CREATE:
+                # Files are picked up once they are closed, new directories may already contain files
+                if is_dir:
+                    self.__add_watches(path)
+                    events.extend(self.scan_directory(path))
+            elif mask & IN_CLOSE_WRITE:
+                events.append(WatchEvent("changed", path))
+            elif mask & IN_DELETE:
+                events.append(WatchEvent("removed", path, is_dir=is_dir))
+
+        # Moved out of the collection
+        for path, is_dir in moved_from.values():
+            events.append(WatchEvent("removed", path, is_dir=is_dir))
+        return events
+
+    def close(self):
+        os.close(self.__fd)
+
+
+class PollingWatcher(Watcher):
+    # Compares a snapshot of the file stats every interval, for systems and mounts without inotify
+    interval: float
+    __snapshot: Dict[str, FileStat]
+    __next_poll: float
+
+    def __init__(self, base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+                 follow_symlinks: bool = False, interval: float = 60):
+        super().__init__(base_path, exclude_patterns, follow_symlinks)
+        self.interval = interval
+        self.__snapshot = self.__take_snapshot()
+        self.__next_poll = time.monotonic() + interval
+        logger.info(f"Polling {len(self.__snapshot)} files every {interval:.0f}s")
+
+    def __take_snapshot(self) -> Dict[str, FileStat]:
+        snapshot = {}
+        for entry in walk_files(self.base_path, self.exclude_patterns, self.follow_symlinks):
+            try:
+                snapshot[entry.path] = FileStat.from_dir_entry(entry)
+            except OSError:
+                continue
+        return snapshot
+
+    def events(self, timeout: float) -> List[WatchEvent]:
+        wait_time = self.__next_poll - time.monotonic()
+        if wait_time > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait_time, 0))
+        self.__next_poll = time.monotonic() + self.interval
+
+        old_snapshot = self.__snapshot
+        self.__snapshot = self.__take_snapshot()
+        removed = {file_stat: path for path, file_stat in old_snapshot.items() if path not in self.__snapshot}
+        events = []
+        for path, file_stat in self.__snapshot.items():
+            if old_snapshot.get(path) == file_stat:
+                continue
+            old_path = removed.pop(file_stat, None) if path not in old_snapshot else None
+            if old_path is not None:
+                events.append(WatchEvent("moved", path, old_path))
+            else:
+                events.append(WatchEvent("changed", path))
+        events.extend(WatchEvent("removed", path) for path in removed.values())
+        return events
+
+
+def create_watcher(base_path: str | Path, exclude_patterns: Iterable[str] = DEFAULT_EXCLUDE_PATTERNS,
+                   follow_symlinks: bool = False, poll_interval: float = 60, polling: bool = False) -> Watcher:
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(base_path, exclude_patterns, follow_symlinks)
+        except OSError as e:
+            logger.warn(f"Can't use inotify, falling back to polling: {e}")
+    return PollingWatcher(base_path, exclude_patterns, follow_symlinks, poll_interval)
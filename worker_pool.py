@@ -0,0 +1,67 @@
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+
+from hasher import HashFunction
+
+# Imported once when a worker starts instead of with its first file, missing optional modules are skipped
+IO_WARM_MODULES = ("hasher", "hashlib", "xxhash", "blake3")
+CPU_WARM_MODULES = ("hasher", "video_phash", "numpy", "PIL.Image", "imagehash", "imagedominantcolour",
+                    "videohash2.videoduration")
+
+
+def warm_imports(module_names: Iterable[str]):
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            continue
+
+
+def hash_batch(hash_function: HashFunction,
+               jobs: List[Tuple[Path, Set[str]]]) -> List[Tuple[Path, Dict[str, str]]]:
+    # Several small files per task, one round trip instead of one per file
+    return [hash_function(file_path, hash_names) for file_path, hash_names in jobs]
+
+
+class WorkerPool:
+    # Process pools that live as long as the program, shared by all hashing phases and watch batches.
+    # Under spawn every worker re-imports its modules, so workers are only started once.
+    io_workers: int
+    cpu_workers: int
+    __io_executor: Optional[ProcessPoolExecutor]
+    __cpu_executor: Optional[ProcessPoolExecutor]
+
+    def __init__(self, io_workers: int, cpu_workers: int):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.__io_executor = None
+        self.__cpu_executor = None
+
+    @property
+    def io_executor(self) -> ProcessPoolExecutor:
+        if self.__io_executor is None:
+            self.__io_executor = ProcessPoolExecutor(max_workers=self.io_workers, initializer=warm_imports,
+                                                     initargs=(IO_WARM_MODULES,))
+        return self.__io_executor
+
+    @property
+    def cpu_executor(self) -> ProcessPoolExecutor:
+        if self.__cpu_executor is None:
+            self.__cpu_executor = ProcessPoolExecutor(max_workers=self.cpu_workers, initializer=warm_imports,
+                                                      initargs=(CPU_WARM_MODULES,))
+        return self.__cpu_executor
+
+    def shutdown(self):
+        for executor in (self.__io_executor, self.__cpu_executor):
+            if executor is not None:
+                executor.shutdown()
+        self.__io_executor = None
+        self.__cpu_executor = None
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()